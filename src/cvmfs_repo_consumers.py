@@ -1,20 +1,31 @@
 
 import os
 import sys
-import subprocess
 import socket
 import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import threading
+import shutil
+from collections import deque
 import time
+import uuid
 import ssl
 import json
-import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError, BotoCoreError
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from datetime import datetime
 import requests
 import hvac
+import repo_journal
+import tarball
+import s3_client
+from s3_client import S3Client
+import metrics
+from zabbix_sender import ZabbixSender
 
 
 with open("parameters.json") as json_data_file:
@@ -36,22 +47,53 @@ SSL_CLIENT_CERT             = data["ssl"]['client_cert']
 SSL_CLIENT_KEY              = data["ssl"]['client_key']
 ZBX_SERVER                  = data["zabbix"]['proxy_server']
 ZBX_ITEM_KEY                = data["zabbix"]['item_key1']
+ZABBIX                      = ZabbixSender(ZBX_SERVER, ZBX_ITEM_KEY)
 V_URL                       = data["vault"]['vault_url']
 V_ROLEID                    = data["vault"]['role_id']
 V_SECRETID                  = data["vault"]['secret_id']
+METRICS_PORT                = data.get("metrics", {}).get('port', 0)                # 0 = metrics endpoint disabled
+RMQ_CONNECTIONS             = data.get("consumer", {}).get('connections', 4)    # TLS connections shared by all the queues
+CONSUMER_WORKERS            = data.get("consumer", {}).get('workers', 20)       # Threads running downloads and Vault calls
+REPO_MAX_WORKERS            = data.get("consumer", {}).get('repo_workers', 4)   # Concurrent messages of the same repository
+MAX_BACKLOG                 = data.get("consumer", {}).get('max_backlog', 200)  # Waiting or running tasks (messages, records) before pausing
+MIN_FREE_GB                 = data.get("consumer", {}).get('min_free_gb', 10)   # Pause consuming when /data/cvmfs has less free space
+DL_MAX_CONCURRENCY          = data.get("download", {}).get('max_concurrency', 10)        # Parallel parts per download
+DL_CHUNKSIZE_MB             = data.get("download", {}).get('multipart_chunksize_mb', 64)  # Size of each part
+DL_THRESHOLD_MB             = data.get("download", {}).get('multipart_threshold_mb', 64)  # Objects bigger than this are downloaded in parts
+DL_MAX_BANDWIDTH_MB         = data.get("download", {}).get('max_bandwidth_mb', 0)         # MB/s per download, 0 = unlimited
+STREAM_TARBALLS             = data.get("consumer", {}).get('stream_tarballs', True)  # Tarballs streamed from S3 into cvmfs_server ingest by the sync
 PREFETCH_COUNT              = 10
-CHECK_INTERVAL              = 1800 # 30 minutes
-RUNNING_THREADS             = {}
-
-
-# Alerts sent to Zabbix server
+CHECK_INTERVAL              = data.get("consumer", {}).get('reconcile_interval', 300)  # Safety net of the event driven queue discovery
+QUEUES_PAGE_SIZE            = 500
+RMQ_EVENT_EXCHANGE          = 'amq.rabbitmq.event'  # rabbitmq_event_exchange plugin
+RMQ_HEARTBEAT               = 60   # The event loop is never blocked by the message processing
+RECONNECT_DELAY             = 5    # Seconds before reopening a closed connection or channel
+NACK_DELAY                  = 30   # Seconds before a failed message is requeued
+BACKPRESSURE_CHECK          = 10   # Seconds between two checks of the free space in /data/cvmfs
+EXECUTOR                    = ThreadPoolExecutor(max_workers=CONSUMER_WORKERS, thread_name_prefix='worker')
+S3                          = S3Client(RGW_ACCESS_KEY, RGW_SECRET_KEY, RGW_ROLE, RGW_ENDPOINT, RGW_REGION)
+TRANSFER_CONFIG             = TransferConfig(
+    multipart_threshold=DL_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=DL_CHUNKSIZE_MB * 1024 * 1024,
+    max_concurrency=DL_MAX_CONCURRENCY,
+    max_bandwidth=DL_MAX_BANDWIDTH_MB * 1024 * 1024 if DL_MAX_BANDWIDTH_MB else None
+    )
+VAULT_TOKEN_MARGIN          = 60   # Login again 1 minute before the Vault token lease expires
+VAULT_KEYS_TTL              = 3600 # Seconds the repository keys read from Vault are reused
+VAULT_CLIENT                = {}   # Shared Vault client and the expiration of its token
+VAULT_LOCK                  = threading.Lock()
+REPO_KEYS_CACHE             = {}   # repository_name -> Vault path (personal or group), keys and their expiration
+MESSAGES                    = metrics.Counter('cvmfs_consumer_messages_total', 'Messages processed per queue', ['queue', 'result'])
+RECORDS                     = metrics.Counter('cvmfs_consumer_records_total', 'Bucket notification records processed', ['bucket', 'operation', 'result'])
+BACKLOG                     = metrics.Gauge('cvmfs_consumer_backlog', 'Messages received and not yet completed')
+DOWNLOAD_BYTES              = metrics.Counter('cvmfs_download_bytes_total', 'Bytes downloaded from S3', ['bucket'])
+DOWNLOAD_SECONDS            = metrics.Histogram('cvmfs_download_seconds', 'Duration of the S3 downloads', ['bucket'])
+VAULT_SECONDS               = metrics.Histogram('cvmfs_vault_request_seconds', 'Duration of the Vault requests', ['operation'])
+
+
+# Alerts sent to Zabbix server, buffered and sent in batches by a background thread
 def send_to_zabbix(message):
-    HOSTNAME =socket.gethostname()
-    cmd = f'zabbix_sender -z {ZBX_SERVER} -s {HOSTNAME} -k {ZBX_ITEM_KEY} -o "{message}"'
-    try:
-        subprocess.run(cmd, shell=True)
-    except Exception as e:
-        logging.error(f"Zabbix notification failed: {e}")
+    ZABBIX.send(message)
 
 
 
@@ -77,36 +119,13 @@ def create_ssl_context():
 
 
 
-# S3 client
-def s3_client():
-    sts_client = boto3.client(
-        'sts',
-        aws_access_key_id=RGW_ACCESS_KEY,
-        aws_secret_access_key=RGW_SECRET_KEY,
-        endpoint_url= RGW_ENDPOINT,
-        region_name = RGW_REGION
-        )
-    response = sts_client.assume_role(
-        RoleArn=f'arn:aws:iam:::role/{RGW_ROLE}',
-        RoleSessionName='Bob',
-        DurationSeconds=3600
-        )
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id = response['Credentials']['AccessKeyId'],
-        aws_secret_access_key = response['Credentials']['SecretAccessKey'],
-        aws_session_token = response['Credentials']['SessionToken'],
-        endpoint_url=RGW_ENDPOINT,
-        region_name=RGW_REGION
-        )
-    return s3
-
-
 # VAUL AppRole login method
 def vault_login_approle(client):
     try:
-        client.auth.approle.login(role_id=V_ROLEID,secret_id=V_SECRETID)
+        with VAULT_SECONDS.time(operation='login'):
+            response = client.auth.approle.login(role_id=V_ROLEID,secret_id=V_SECRETID)
         logging.info("Login to Vault server successful.")
+        return response
     except hvac.exceptions.InvalidRequest as e:
         error_msg=f'Invalid request error: {e}'
         logging.error(error_msg)
@@ -123,29 +142,73 @@ def vault_login_approle(client):
         error_msg=f'An unexpected error occurred: {e}'
         logging.error(error_msg)
         send_to_zabbix(error_msg)
+    return None
+
+
+# Vault client shared by the worker threads. A new AppRole login is done only when the token lease is expiring
+# expired: client whose token was refused, the login is done again only if it is still the cached one
+def vault_client(expired=None):
+    with VAULT_LOCK:
+        if VAULT_CLIENT and VAULT_CLIENT['client'] is not expired and time.time() < VAULT_CLIENT['expiration']:
+            return VAULT_CLIENT['client']
+        client = hvac.Client(V_URL)
+        response = vault_login_approle(client)
+        lease_duration = response['auth']['lease_duration'] if response else 0
+        VAULT_CLIENT['client'] = client
+        VAULT_CLIENT['expiration'] = time.time() + lease_duration - VAULT_TOKEN_MARGIN
+        return client
+
+
+# Read the CVMFS repo keys from Vault. We don't know if the repo is personal or group,
+# the path which worked last time (known_path) is tried first
+def read_repo_keys(repository_name, principalId, known_path=None):
+    paths = ["secrets/data/"+principalId+"/cvmfs_keys/"+repository_name+"/",                                 # case personal repo
+             "secrets/data/groups/"+repository_name.split('.')[0]+"/cvmfs_keys/"+repository_name+"/"]       # case group repo
+    if known_path in paths:
+        paths.remove(known_path)
+        paths.insert(0, known_path)
+    client = vault_client()
+    for PATH in paths:
+        try:
+            with VAULT_SECONDS.time(operation='read'):
+                read_response = client.read(path=PATH)
+        except hvac.exceptions.Forbidden:
+            # Token revoked or expired before its lease: login again and retry once
+            client = vault_client(expired=client)
+            with VAULT_SECONDS.time(operation='read'):
+                read_response = client.read(path=PATH)
+        if read_response is not None:
+            return {'path': PATH, 'keys': read_response['data']['data'], 'expiration': time.time() + VAULT_KEYS_TTL}
+    raise Exception(f"CVMFS keys for {repository_name} repository not found in Vault.")
+
+
+# Write a key file only if its content changed
+def write_key_file(key_file, content):
+    try:
+        with open(key_file) as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+    with open(key_file, 'w') as file:
+        file.write(content)
 
 
 # Retrive CVMFS repo keys from vault and copy them in /data/cvmfs/{repository_name}/keys
+# Keys are cached per repository for VAULT_KEYS_TTL seconds
 def get_repo_keys(bucket, principalId):
+    repository_name=bucket+".infn.it"
     try:
-        client = hvac.Client(V_URL)
-        vault_login_approle(client)
-        repository_name=bucket+".infn.it"
-        # we don't know if the repo is personal or group 
-        PATH = "secrets/data/"+principalId+"/cvmfs_keys/"+repository_name+"/"
-        read_response = client.read(path=PATH)
-        if read_response is None:
-            # case group repo (otherwise case personal repo)
-            PATH = "secrets/data/groups/"+repository_name.split('.')[0]+"/cvmfs_keys/"+repository_name+"/"
-            read_response = client.read(path=PATH)
+        cached = REPO_KEYS_CACHE.get(repository_name)
+        if cached is None or time.time() >= cached['expiration']:
+            cached = read_repo_keys(repository_name, principalId, cached['path'] if cached else None)
+            REPO_KEYS_CACHE[repository_name] = cached
         # Save keys as files
         fileExt=['pub','gw','crt']
         key_list = ['publicKey','gatewayKey','certificateKey']
         for i in range(len(key_list)):
             keys=f"/data/cvmfs/{repository_name}/keys/{bucket}.infn.it.{fileExt[i]}"
-            with open(keys, 'w') as file:
-                file.write(read_response['data']['data'][key_list[i]])
-                file.close()
+            write_key_file(keys, cached['keys'][key_list[i]])
     except Exception as e:
         error_msg=f'{e}'
         logging.warning(error_msg)
@@ -153,68 +216,135 @@ def get_repo_keys(bucket, principalId):
     return repository_name
 
 
-def process_messages(message):
+# Create the repository folders in /data/cvmfs and get the repo keys, once per bucket of a message
+def prepare_repository(bucket, principalId):
+    base_path = f"/data/cvmfs/{bucket}.infn.it"                                         # base_path=/data/cvmfs/repo17.infn.it
+    for folder in [base_path] + [os.path.join(base_path, d) for d in ['to_extract', 'keys']]:
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+            logging.info(f"Directory {folder} created successfully.")
+    # Get repo keys from Vault for the CVMFS repo
+    get_repo_keys(bucket, principalId)
+
+
+def process_record(record):
     try:
-        msg=json.loads(message.decode("utf-8"))
-        bucket = msg['Records'][0]['s3']['bucket']['name']                              # bucket=repo01
-        key = msg['Records'][0]['s3']['object']['key']                                  # key=cvmfs/netCDF-92
-        Operation = msg['Records'][0]['eventName']                                      # Operation=ObjectCreated:Put ==> download
-        principalId = msg['Records'][0]['s3']['bucket']['ownerIdentity']['principalId'] # principalId=34158350-c746-4918-82ab-9004dd03f95b
-        logging.info(f"Operation: {Operation}, Bucket: {bucket}, Key: {key}, principalId: {principalId}")
+        bucket = record['s3']['bucket']['name']                                         # bucket=repo01
+        key = record['s3']['object']['key']                                             # key=cvmfs/netCDF-92
+        Operation = record['eventName']                                                 # Operation=ObjectCreated:Put ==> download
+        logging.info(f"Operation: {Operation}, Bucket: {bucket}, Key: {key}")
         dir_file, filename = os.path.split(key)                                         # dir_file=cvmfs, filename=netCDF-92        
-        full_path=f"/data/cvmfs/{bucket}.infn.it{dir_file[5:]}/{filename}"
-        base_path = os.path.dirname(full_path)                                          # base_path=/data/cvmfs/repo17.infn.it
-        delete_dir = os.path.join(base_path, 'to_delete')
-        extract_dir= os.path.join(base_path, 'to_extract')
-        keys_dir= os.path.join(base_path, 'keys')
-        # Create the directory for the file path (ignoring the file itself if present), even with delete operation
-        if not os.path.exists(base_path):
-                os.makedirs(base_path)
-                logging.info(f"Directory {base_path} created successfully.")
-        if not os.path.exists(delete_dir):
-                os.makedirs(delete_dir)
-                logging.info(f"Directory {delete_dir} created successfully.")
-        if not os.path.exists(extract_dir):
-                os.makedirs(extract_dir)
-                logging.info(f"Directory {extract_dir} created successfully.")
-        if not os.path.exists(keys_dir):
-                os.makedirs(keys_dir)
-                logging.info(f"Directory {keys_dir} created successfully.")
-        
-        # Get repo keys from Vault for the CVMFS repo
-        get_repo_keys(bucket, principalId)
-
-        # UPLOAD files and .tar files
-        if ("ObjectCreated" in Operation):
-             if filename.endswith('.tar'):
-                 to_extract_filename="/data/cvmfs/" + bucket + ".infn.it" + "/to_extract" + dir_file[5:] + "/" + filename
-                 return download_from_s3(bucket, key, to_extract_filename)
-             else: 
-                 return download_from_s3(bucket, key, full_path)
+        base_path = f"/data/cvmfs/{bucket}.infn.it"
+        path = f"{dir_file[5:]}/{filename}".lstrip('/')                                 # path in the CVMFS repo, e.g. netCDF-92
+        # Tarballs (.tar, .tar.gz, .tar.zst, ...) are staged in to_extract to be ingested
+        staged_path = f"{base_path}/to_extract/{path}" if tarball.is_tarball(filename) else f"{base_path}/{path}"
+
+        # UPLOAD of tarballs streamed by cvmfs_repo_sync: only recorded in the journal with their S3 source
+        if ("ObjectCreated" in Operation) and tarball.is_tarball(filename) and STREAM_TARBALLS:
+             # A previous version staged and not yet ingested, removed first so that the sync never ingests it for the new one
+             if os.path.isfile(staged_path):
+                 os.remove(staged_path)
+             repo_journal.record(base_path, path, repo_journal.PUT, source=f"s3://{bucket}/{key}")
+             result = True
+        # UPLOAD files and tarballs
+        elif ("ObjectCreated" in Operation):
+             os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+             # The Put, replacing a pending delete of the same file, is recorded as soon as the file is in place
+             result = download_from_s3(bucket, key, staged_path, (base_path, path))
+        # DELETE operation
+        elif ("ObjectRemoved" in Operation):
+             # The file to be removed from the CVMFS repo is recorded in the repository journal, replacing a pending upload
+             repo_journal.record(base_path, path, repo_journal.DELETE)
+             if os.path.isfile(staged_path):
+                 os.remove(staged_path)
+                 logging.info(f"Removed {staged_path}, not yet published.")
+             result = True
         else:
-             # DELETE operation
-             if ("ObjectRemoved" in Operation):
-                # The file to be removed (file_to_be_removed) from CVMFS repo is written in a .txt file (to_delete_file) located under the to_delete folder
-                file_to_be_removed= "/cvmfs/" + bucket + ".infn.it" + dir_file[5:] + "/" + filename
-                to_delete_file = base_path + "/to_delete/" + bucket + "-infn-it.txt"
-                with open(to_delete_file, "a") as f:
-                    f.write(file_to_be_removed + "\n")
-                return True
-             else:
-                logging.info("Operation not supported.")
+             logging.info("Operation not supported.")
+             result = False
+        logging.info(f"Record {Operation} {bucket}/{key}: {'succeeded' if result else 'failed'}.")
+        RECORDS.inc(bucket=bucket, operation=Operation.split(':')[0], result='succeeded' if result else 'failed')
+        return result
 
     except Exception as e:
-            error_msg=f"Failed to process message: {str(e)}"
+            RECORDS.inc(bucket=record.get('s3', {}).get('bucket', {}).get('name', ''), operation=record.get('eventName', '').split(':')[0], result='failed')
+            error_msg=f"Failed to process record: {str(e)}"
             logging.warning(error_msg)    
             send_to_zabbix(error_msg)
     return False
 
 
+# A bucket notification can carry several records. They are grouped by object key keeping the message order: the records
+# of the same key, e.g. a Put followed by a Delete, are processed one after the other, the groups of different keys
+# concurrently by the WorkPool. Returns the groups of records, None if the message cannot be processed
+def prepare_message(body):
+    try:
+        msg=json.loads(body.decode("utf-8"))
+        groups = {}
+        principals = {}
+        for record in msg['Records']:
+            bucket = record['s3']['bucket']['name']
+            groups.setdefault((bucket, record['s3']['object']['key']), []).append(record)
+            principals.setdefault(bucket, record['s3']['bucket']['ownerIdentity']['principalId'])   # principalId=34158350-c746-4918-82ab-9004dd03f95b
+        for bucket, principalId in principals.items():
+            prepare_repository(bucket, principalId)
+        return list(groups.values())
+
+    except Exception as e:
+            error_msg=f"Failed to process message: {str(e)}"
+            logging.warning(error_msg)    
+            send_to_zabbix(error_msg)
+    return None
+
+
+# Records of the same object key, in message order. All of them are processed even if one fails
+def process_records(records):
+    return all([process_record(record) for record in records])
+
+
 
-def download_from_s3(bucket, key, Filename):    
-    s3=s3_client()
+# Download into a hidden temporary file next to Filename and rename it atomically once complete,
+# so that cvmfs_repo_sync never publishes a partially written file.
+# journal: (repository path, path in the repository) of the Put recorded right after the rename. Regular files small enough
+# to have a bulk hash in CVMFS are hashed before the rename, while still in the page cache, so that the sync skips identical files
+def s3_download(s3, bucket, key, Filename, journal=None):
+    folder, name = os.path.split(Filename)
+    temp_file = os.path.join(folder, f".{name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        with DOWNLOAD_SECONDS.time(bucket=bucket):
+            try:
+                s3.download_file(bucket, key, temp_file, Config=TRANSFER_CONFIG)
+            except FileNotFoundError:
+                # Staging folder left empty by a publish and removed by cvmfs_repo_sync in the meantime
+                if os.path.isdir(folder):
+                    raise
+                os.makedirs(folder, exist_ok=True)
+                s3.download_file(bucket, key, temp_file, Config=TRANSFER_CONFIG)
+        size = os.path.getsize(temp_file)
+        DOWNLOAD_BYTES.inc(size, bucket=bucket)
+        file_hash = None
+        if journal and not tarball.is_tarball(name) and size <= repo_journal.HASHED_MAX_SIZE:
+            file_hash = repo_journal.content_hash(temp_file)
+        os.replace(temp_file, Filename)
+        if journal:
+            repo_journal.record(journal[0], journal[1], repo_journal.PUT, hash=file_hash)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def download_from_s3(bucket, key, Filename, journal=None):    
+    s3=S3.client()
     try:        
-        s3.download_file(bucket, key, Filename)
+        try:
+            s3_download(s3, bucket, key, Filename, journal)
+        except ClientError as e:
+            if not s3_client.expired_token(e):
+                raise
+            # Expired or revoked STS token: assume the role again and retry once
+            logging.info(f"S3 credentials rejected ({e.response['Error']['Code']}), refreshing STS credentials.")
+            s3 = S3.client(expired=s3)
+            s3_download(s3, bucket, key, Filename, journal)
         logging.info(f"Successfully downloaded {key} to {Filename}.")
         return True
 
@@ -225,7 +355,7 @@ def download_from_s3(bucket, key, Filename):
            logging.info("Download path not found. Defaulting to /tmp.")
            download_path = os.path.join('/tmp', os.path.basename(Filename))
            try:
-               s3.download_file(bucket, key, download_path)
+               s3_download(s3, bucket, key, download_path)
                logging.info(f"File {key} downloaded successfully to {download_path}")
                return True
            except ClientError as e:
@@ -269,50 +399,275 @@ def download_from_s3(bucket, key, Filename):
 
 
 
-# RabbitMQ connection setup
-def connect_rabbitmq():
+# RabbitMQ connection setup on the asyncio event loop
+def connect_rabbitmq(loop, name, on_open, on_open_error, on_close):
     credentials = pika.PlainCredentials(RMQ_USER, RMQ_PASSWORD)
     ssl_context = create_ssl_context()
-    return pika.BlockingConnection(pika.ConnectionParameters(
+    return AsyncioConnection(pika.ConnectionParameters(
         host=RMQ_HOST,
         port=RMQ_PORT,
         credentials=credentials,
         ssl_options=pika.SSLOptions(context=ssl_context), 
-        heartbeat=3600, 
+        heartbeat=RMQ_HEARTBEAT, 
         blocked_connection_timeout=300,
         retry_delay=5, 
-        connection_attempts=3
-        ))
-
-
+        connection_attempts=3,
+        client_properties={'connection_name': f'{socket.gethostname()}-{name}'}
+        ),
+        on_open_callback=on_open,
+        on_open_error_callback=on_open_error,
+        on_close_callback=on_close,
+        custom_ioloop=loop)
+
+
+
+# True when /data/cvmfs has less than MIN_FREE_GB free
+def low_disk_space():
+    return shutil.disk_usage("/data/cvmfs").free < MIN_FREE_GB * 1024**3
+
+
+
+# A message received on a channel, acked once all its groups of records are processed
+class Message:
+
+    def __init__(self, ch, method):
+        self.ch = ch
+        self.method = method
+        self.remaining = 0              # groups of records not yet processed
+        self.results = []
+
+
+# Work pool between the consumer callbacks and the EXECUTOR threads, used only from the event loop thread.
+# A message is first prepared (parsed, repository keys read), then each group of records of the same object key is a task.
+# Tasks are dispatched round robin between the repositories, with at most REPO_MAX_WORKERS tasks of the same
+# repository and CONSUMER_WORKERS overall in progress, so small files do not wait behind a big download.
+# The records of a message already started are queued before the other messages of its repository.
+# Consuming is paused when MAX_BACKLOG tasks are waiting or /data/cvmfs is running out of space.
+class WorkPool:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.connections = []
+        self.pending = {}               # repository -> tasks waiting for a worker: (message, function, argument)
+        self.running = {}               # repository -> tasks in progress
+        self.active = 0
+        self.paused = False
+
+    def backlog(self):
+        return self.active + sum(len(tasks) for tasks in self.pending.values())
+
+    # Consumer callback
+    def submit(self, ch, method, properties, body):
+        self.pending.setdefault(method.routing_key, deque()).append((Message(ch, method), prepare_message, body))
+        self.dispatch()
+        self.check_backpressure()
+
+    def dispatch(self):
+        while self.active < CONSUMER_WORKERS:
+            ready = [repo for repo in self.pending if self.running.get(repo, 0) < REPO_MAX_WORKERS]
+            if not ready:
+                return
+            repo = ready[0]
+            tasks = self.pending.pop(repo)
+            message, function, argument = tasks.popleft()
+            # Move the repository at the end of the round robin
+            if tasks:
+                self.pending[repo] = tasks
+            self.running[repo] = self.running.get(repo, 0) + 1
+            self.active += 1
+            future = self.loop.run_in_executor(EXECUTOR, function, argument)
+            # Done callbacks of asyncio futures run on the event loop thread, where the channel can be safely used
+            future.add_done_callback(lambda f, message=message, function=function, repo=repo: self.complete(message, function, repo, f))
+
+    def complete(self, message, function, repo, future):
+        self.running[repo] -= 1
+        if not self.running[repo]:
+            del self.running[repo]
+        self.active -= 1
+        result = None if future.cancelled() or future.exception() is not None else future.result()
+        if function is prepare_message and result:
+            message.remaining = len(result)
+            tasks = self.pending.setdefault(repo, deque())
+            tasks.extendleft((message, process_records, records) for records in reversed(result))
+        elif function is prepare_message:
+            self.finish(message, result is not None)
+        else:
+            message.results.append(bool(result))
+            message.remaining -= 1
+            if not message.remaining:
+                self.finish(message, all(message.results))
+        self.dispatch()
+        self.check_backpressure()
+
+    def finish(self, message, succeeded):
+        ch, method = message.ch, message.method
+        if len(message.results) > 1:
+            logging.info(f"Message with {len(message.results)} keys: {message.results.count(True)} succeeded, {message.results.count(False)} failed.")
+        if succeeded:
+            if ch.is_open:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                MESSAGES.inc(queue=method.routing_key, result='acked')
+                logging.info(f"Acked: {method.routing_key}")
+            else:
+                logging.warning(f"Channel closed before ack, {method.routing_key} message will be redelivered.")
+        else:
+            error_msg=f"Failed processing. Nacked: {method.routing_key}, requeued in {NACK_DELAY} seconds."
+            logging.warning(error_msg)
+            send_to_zabbix(error_msg)
+            MESSAGES.inc(queue=method.routing_key, result='nacked')
+            self.loop.call_later(NACK_DELAY, nack_message, ch, method)
+
+    def check_backpressure(self):
+        backlog = self.backlog()
+        BACKLOG.set(backlog)
+        if not self.paused and (backlog >= MAX_BACKLOG or low_disk_space()):
+            logging.warning(f"Pausing consumers: {backlog} tasks in progress, {shutil.disk_usage('/data/cvmfs').free // 1024**3} GB free in /data/cvmfs.")
+            self.paused = True
+            for connection in self.connections:
+                connection.pause()
+        elif self.paused and backlog <= MAX_BACKLOG // 2 and not low_disk_space():
+            logging.info(f"Resuming consumers: {backlog} tasks in progress.")
+            self.paused = False
+            for connection in self.connections:
+                connection.resume()
+
+    # The free space can change without any message being processed
+    async def watch_backpressure(self):
+        while True:
+            self.check_backpressure()
+            await asyncio.sleep(BACKPRESSURE_CHECK)
+
+
+def nack_message(ch, method):
+    if ch.is_open:
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+
+
+
+# One RabbitMQ connection multiplexing a channel per consumed queue. 
+# All the connections run on the same event loop, closed connections and channels are reopened after RECONNECT_DELAY
+class ConsumerConnection:
+
+    def __init__(self, loop, name, pool):
+        self.loop = loop
+        self.name = name
+        self.pool = pool
+        self.queues = set()             # queues assigned to this connection
+        self.channels = {}              # queue name -> open channel
+        self.consumer_tags = {}         # queue name -> consumer tag, empty while paused
+        self.on_queue_event = None      # set on the connection listening to the broker queue events
+        self.connection = None
+        self.connect()
+
+    def connect(self):
+        self.connection = connect_rabbitmq(self.loop, self.name, self.on_open, self.on_open_error, self.on_close)
+
+    def on_open(self, connection):
+        logging.info(f"Connection {self.name} to RabbitMQ opened.")
+        for queue in self.queues:
+            self.open_channel(queue)
+        if self.on_queue_event:
+            self.connection.channel(on_open_callback=self.on_events_channel_open)
+
+    # Exclusive queue bound to the event exchange, receiving the queue.created and queue.deleted events
+    def on_events_channel_open(self, ch):
+        ch.add_on_close_callback(self.on_events_channel_close)
+        ch.queue_declare(queue='', exclusive=True, auto_delete=True, callback=lambda frame: self.on_events_queue(ch, frame.method.queue))
+
+    def on_events_queue(self, ch, events_queue):
+        for routing_key in ['queue.created', 'queue.deleted']:
+            ch.queue_bind(queue=events_queue, exchange=RMQ_EVENT_EXCHANGE, routing_key=routing_key)
+        ch.basic_consume(queue=events_queue, on_message_callback=self.on_event, auto_ack=True)
+        logging.info(f"[✓] Listening on queue events from {RMQ_EVENT_EXCHANGE}")
+
+    def on_event(self, ch, method, properties, body):
+        queue = (properties.headers or {}).get('name')
+        if isinstance(queue, bytes):
+            queue = queue.decode()
+        if queue:
+            logging.info(f"Event {method.routing_key}: {queue}")
+            self.on_queue_event(method.routing_key, queue)
+
+    def on_events_channel_close(self, ch, reason):
+        if self.connection.is_open:
+            # e.g. rabbitmq_event_exchange plugin not enabled
+            error_msg=f"Queue events not available ({reason}), new queues are found every {CHECK_INTERVAL} seconds."
+            logging.warning(error_msg)
+            send_to_zabbix(error_msg)
 
-# Consumer callback
-def callback(ch, method, properties, body):
-    if process_messages(body):
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        logging.info(f"Acked: {method.routing_key}")
-    else:
-        error_msg=f"Failed processing. Not acked: {method.routing_key}."
-        logging.warning(error_msg)
+    def on_open_error(self, connection, error):
+        error_msg=f"Connection {self.name} to RabbitMQ failed: {error}"
+        logging.error(error_msg)
         send_to_zabbix(error_msg)
+        self.loop.call_later(RECONNECT_DELAY, self.connect)
 
-
-
-# Worker thread per queue
-def worker(queue_name):
-    try:
-        conn = connect_rabbitmq()
-        ch = conn.channel()
+    def on_close(self, connection, reason):
+        self.channels.clear()
+        self.consumer_tags.clear()
+        error_msg=f"Connection {self.name} to RabbitMQ closed: {reason}"
+        logging.error(error_msg)
+        send_to_zabbix(error_msg)
+        self.loop.call_later(RECONNECT_DELAY, self.connect)
+
+    def add_queue(self, queue):
+        self.queues.add(queue)
+        if self.connection.is_open:
+            self.open_channel(queue)
+
+    def remove_queue(self, queue):
+        if queue in self.queues:
+            logging.info(f"Queue {queue} deleted, stop consuming it.")
+            self.queues.discard(queue)
+            if queue in self.channels:
+                self.channels[queue].close()
+
+    def open_channel(self, queue):
+        if queue in self.queues and queue not in self.channels and self.connection.is_open:
+            self.connection.channel(on_open_callback=lambda ch: self.on_channel_open(ch, queue))
+
+    def on_channel_open(self, ch, queue):
+        self.channels[queue] = ch
+        ch.add_on_close_callback(lambda ch, reason: self.on_channel_close(queue, reason))
         ch.basic_qos(prefetch_count=PREFETCH_COUNT)
-        ch.queue_declare(queue=queue_name, durable=True, arguments={'x-queue-type':'quorum'})
-        ch.basic_consume(queue=queue_name, on_message_callback=callback)
-        logging.info(f"[✓] Listening on: {queue_name}")
-        ch.start_consuming()
-    except Exception as e:
-        error_msg=f"Error in {queue_name} queue thread: {e}"
+        ch.queue_declare(queue=queue, durable=True, arguments={'x-queue-type':'quorum'})
+        if not self.pool.paused:
+            self.consume(queue)
+
+    def consume(self, queue):
+        self.consumer_tags[queue] = self.channels[queue].basic_consume(queue=queue, on_message_callback=self.pool.submit)
+        logging.info(f"[✓] Listening on: {queue}")
+
+    # Stop the deliveries, messages already received are still acked on their channel
+    def pause(self):
+        for queue, consumer_tag in self.consumer_tags.items():
+            self.channels[queue].basic_cancel(consumer_tag)
+        self.consumer_tags.clear()
+
+    def resume(self):
+        for queue in self.channels:
+            if queue not in self.consumer_tags:
+                self.consume(queue)
+
+    def on_channel_close(self, queue, reason):
+        self.channels.pop(queue, None)
+        self.consumer_tags.pop(queue, None)
+        if not self.connection.is_open or queue not in self.queues:
+            return                                          # channels are reopened with the connection
+        if isinstance(reason, pika.exceptions.ChannelClosedByBroker) and reason.reply_code == 404:
+            # Queue deleted: it will be consumed again if the queue discovery finds it
+            logging.info(f"Queue {queue} not found, stop consuming it.")
+            self.queues.discard(queue)
+            return
+        error_msg=f"Error in {queue} queue channel: {reason}"
         logging.error(error_msg)
         send_to_zabbix(error_msg)
+        self.loop.call_later(RECONNECT_DELAY, self.open_channel, queue)
+
+
 
+# Queues of the CVMFS repositories
+def consumed_queue(name):
+    return name not in RMQ_EXCLUDED_QUEUES and 'amq.gen' not in name
 
 
 # Getting RabbitMQ queues
@@ -320,13 +675,21 @@ def get_queues():
     url = f'{RMQ_URL}/api/queues'
     try:
         requests.packages.urllib3.disable_warnings()
-        resp = requests.get(url, auth=(RMQ_USER, RMQ_PASSWORD), verify=False,timeout=(5, 10))
-        
-        if resp.status_code == 200:
-            return [q['name'] for q in resp.json() if q['name'] not in RMQ_EXCLUDED_QUEUES and 'amq.gen' not in  q['name']]
-        else:
-            logging.info(f"Failed to fetch queues. {resp.status_code} - {resp.text}")
-            return []
+        queues = []
+        page = 1
+        while True:
+            # Only the queue names, without the statistics, one page at a time
+            params = {'columns': 'name', 'disable_stats': 'true', 'page': page, 'page_size': QUEUES_PAGE_SIZE}
+            resp = requests.get(url, params=params, auth=(RMQ_USER, RMQ_PASSWORD), verify=False,timeout=(5, 10))
+            if resp.status_code != 200:
+                break
+            body = resp.json()
+            queues += [q['name'] for q in body['items'] if consumed_queue(q['name'])]
+            if page >= body['page_count']:
+                return queues
+            page += 1
+        logging.info(f"Failed to fetch queues. {resp.status_code} - {resp.text}")
+        return []
 
     except requests.exceptions.ConnectTimeout:
         error_msg = "Connection timed out while connecting to RabbitMQ API"
@@ -355,23 +718,52 @@ def get_queues():
         return []
 
 
-# Monitor worker threads
-def monitor_threads():
+# Assign a RabbitMQ queue to the connection with the fewest channels
+def assign_queue(connections, queue):
+    if not any(queue in c.queues for c in connections):
+        connection = min(connections, key=lambda c: len(c.queues))
+        logging.info(f"Starting consumer for queue {queue} on {connection.name}")
+        connection.add_queue(queue)
+
+
+# Queue created or deleted, notified by the broker event exchange
+def on_queue_event(connections, event, queue):
+    if not consumed_queue(queue):
+        return
+    if event == 'queue.created':
+        assign_queue(connections, queue)
+    elif event == 'queue.deleted':
+        for connection in connections:
+            connection.remove_queue(queue)
+
+
+# New queues are discovered by the broker events, this periodic check only recovers missed events
+async def monitor_queues(connections):
+    loop = asyncio.get_running_loop()
     while True:
         logging.info("Verify active queues ...")
-        for queue in get_queues():
-            if queue not in RUNNING_THREADS or not RUNNING_THREADS[queue].is_alive():
-                logging.info(f"Starting thread for queue: {queue}")
-                thread = threading.Thread(target=worker, args=(queue,), daemon=True)
-                RUNNING_THREADS[queue] = thread
-                thread.start()
-        time.sleep(CHECK_INTERVAL)
+        for queue in await loop.run_in_executor(None, get_queues):
+            assign_queue(connections, queue)
+        await asyncio.sleep(CHECK_INTERVAL)
+
+
+
+async def run_consumers():
+    loop = asyncio.get_running_loop()
+    pool = WorkPool(loop)
+    pool.connections = [ConsumerConnection(loop, f"consumer-{i}", pool) for i in range(RMQ_CONNECTIONS)]
+    # The first connection also listens to the queue events
+    pool.connections[0].on_queue_event = lambda event, queue: on_queue_event(pool.connections, event, queue)
+    loop.create_task(pool.watch_backpressure())
+    await monitor_queues(pool.connections)
 
 
 
 def main():    
     setup_logging()        
-    monitor_threads()
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT)
+    asyncio.run(run_consumers())
     
 
 
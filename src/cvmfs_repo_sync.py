@@ -7,13 +7,28 @@ import subprocess
 import time
 import logging
 import json
-import socket
+import io
+import queue
+import errno
+import signal
+import fcntl
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from logging.handlers import TimedRotatingFileHandler
+from botocore.exceptions import ClientError
+import repo_journal
+import repo_registry
+import tarball
+from s3_client import S3Client
+from dir_watcher import DirWatcher
+import metrics
+from zabbix_sender import ZabbixSender
 
 my_cvmfs_path = r"/data/cvmfs"                         # Folder path to monitor
 cvmfs_path    = r"/cvmfs/"                             # CVMFS repo base path
-TIME_CHECK    = 60                                          # Wait 60 seconds before check again
+TIME_CHECK    = 60                                          # Wait 60 seconds before check again, without inotify
 
 
 with open("parameters.json") as json_data_file:
@@ -23,16 +38,56 @@ CVMFS_SERVER_URL            = data["cvmfs"]["stratum0_url"]
 CVMFS_UP_STORAGE            = data["cvmfs"]["upstream_storage"]
 ZBX_SERVER                  = data["zabbix"]['proxy_server']
 ZBX_ITEM_KEY                = data["zabbix"]['item_key2']
+ZABBIX                      = ZabbixSender(ZBX_SERVER, ZBX_ITEM_KEY)
+S3                          = S3Client(data["ceph-rgw"]['access_key'], data["ceph-rgw"]['secret_key'], data["ceph-rgw"]['role'],
+                                       data["ceph-rgw"]['url'], data["ceph-rgw"]['region'])
+READ_AHEAD_MB               = data.get("sync", {}).get('read_ahead_mb', 64)    # Buffer of the tarballs streamed from S3, 0 = no read-ahead
+READ_AHEAD_CHUNK            = 1024 * 1024
+TAR_BUFSIZE                 = 1024 * 1024
+CATALOG_POLICY              = data.get("sync", {}).get('catalog_policy', 'bundle')  # bundle: one nested catalog per software/<bundle>,
+                                                                                    # autocatalogs: split by entry count, none
+AUTOCATALOGS_MAX_WEIGHT     = data.get("sync", {}).get('autocatalogs_max_weight', 100000)  # Entries of a catalog before it is split
+DIRTAB                      = ["/software/*"]   # .cvmfsdirtab of the bundle policy, for the files copied by the transactions
+CATALOG_MARKER              = ".cvmfscatalog"
+PUBLISHED_HASH_XATTR        = "user.hash"   # Content hash of a file in /cvmfs, exported by the CVMFS client
+SUBPATH_LEASES              = data.get("sync", {}).get('subpath_leases', True)  # Gateway lease on the folder of the changes, not the whole repo
+CATALOGS_CONFIGURED         = set() # repositories whose autocatalogs configuration was checked by this process
+METRICS_PORT                = data.get("metrics", {}).get('port', 0)        # 0 = metrics endpoint disabled
+FULL_SCAN_INTERVAL          = data.get("sync", {}).get('full_scan_interval', 600)  # Full scan of /data/cvmfs, safety net of inotify
+EVENT_SETTLE                = 2     # Seconds collecting filesystem events before syncing the changed repositories
+SYNC_WORKERS                = data.get("sync", {}).get('workers', 4)                # Repositories synchronized concurrently
+MAX_CHANGES_PER_CYCLE       = data.get("sync", {}).get('max_changes_per_cycle', 500)  # Change-set cap, then the repository goes back in the queue
+SYNC_EXECUTOR               = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix='sync')
+RUNNING_REPOS               = {}    # repository -> future of its sync cycle, at most one per repository
+PENDING_REPOS               = {}    # repository -> [first, last] monotonic time of its changes not yet synchronized
+PENDING_COUNTS              = {}    # repository -> (time of the last change, journal operations) of the waiting repositories
+LAST_PUBLISH                = {}    # repository -> monotonic time of its last sync cycle which published changes
+QUIET_PERIOD                = data.get("sync", {}).get('quiet_period', 10)            # Seconds without changes before a repository is synchronized
+MIN_PUBLISH_INTERVAL        = data.get("sync", {}).get('min_publish_interval', 60)    # Seconds between two publishes of a repository
+MAX_PUBLISH_DELAY           = data.get("sync", {}).get('max_publish_delay', 300)      # Seconds after its first change a repository is synchronized anyway
+MAX_PENDING_CHANGES         = data.get("sync", {}).get('max_pending_changes', 500)    # Journal operations which force the synchronization
+SCHEDULE_TICK               = 5     # Seconds between two checks of the running sync cycles
+COMPLETED_SYNCS             = queue.Queue()     # (repository, future) of the ended sync cycles, handled by the main thread
+FICLONE                     = 0x40049409    # ioctl of the reflink copy, btrfs and xfs
+STAGING_INDEX               = {}    # staging folder -> {relative folder: (mtime, {file: (size, mtime, inode)}, [subfolders])}
+TEMP_FILE_PATTERN           = re.compile(r".*\.[a-fA-F0-9]{8}$")   # Temporary or multipart files: a period followed by 8 hex characters
+TEMP_FILE_MAX_AGE           = 3600  # Seconds, then a temporary file left in the staging area is deleted
+EXCLUDED_FOLDERS            = ['keys', 'to_delete', 'to_extract']   # Bookkeeping folders of the repositories, not published
+TRANSFER_METHODS            = {}    # (staging device, repository device) -> first transfer method worth trying
+UNSUPPORTED_ERRNOS          = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF)
+REPO_IN_TRANSACTION         = {}    # repository -> True if in transaction, loaded from cvmfs_server list once per cycle
+REPO_STATE_LOCK             = threading.Lock()
+CVMFS_SERVER_SECONDS        = metrics.Histogram('cvmfs_server_command_seconds', 'Duration of the cvmfs_server commands', ['repo', 'command'])
+SYNC_CYCLE_SECONDS          = metrics.Histogram('cvmfs_sync_cycle_seconds', 'Duration of a synchronization cycle of a repository', ['repo'])
+STAGED_FILES                = metrics.Gauge('cvmfs_staged_files', 'Files staged in /data/cvmfs waiting to be published', ['repo'])
+TRANSFERS                   = metrics.Counter('cvmfs_sync_transfers_total', 'Staged files transferred into the repositories by method', ['method'])
+SKIPPED_FILES               = metrics.Counter('cvmfs_sync_identical_files_total', 'Staged files identical to the published ones, not published again', ['repo'])
+STAGED_BYTES                = metrics.Gauge('cvmfs_staged_bytes', 'Bytes staged in /data/cvmfs waiting to be published', ['repo'])
 
 
-# Alerts sent to Zabbix server
+# Alerts sent to Zabbix server, buffered and sent in batches by a background thread
 def send_to_zabbix(message):
-    HOSTNAME =socket.gethostname()
-    cmd = f'zabbix_sender -z {ZBX_SERVER} -s {HOSTNAME} -k {ZBX_ITEM_KEY} -o "{message}"'
-    try:
-        subprocess.run(cmd, shell=True)
-    except Exception as e:
-        logging.error(f"Zabbix notification failed: {e}")
+    ZABBIX.send(message)
 
 
 def setup_logging():
@@ -44,15 +99,11 @@ def setup_logging():
             handlers=[TimedRotatingFileHandler(log_file, when='D', interval=7)])
 
 
-# This function deletes temporary files copied in the CVMFS repositories. Their filename end with a period followed by 8 characters
-def delete_temp_files(directory):
-    # re=Regular expression to match filenames
-    pattern = re.compile(r".*\.[a-fA-F0-9]{8}$")  
-    # Loop through files in the specified directory
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)       
-        # Check if it's a file and matches the pattern
-        if os.path.isfile(file_path) and pattern.match(filename):
+# This function deletes temporary or multipart files left in the staging area, only the paths given relative to directory
+def delete_temp_files(directory, filenames):
+    for filename in filenames:
+        file_path = os.path.join(directory, filename)
+        if TEMP_FILE_PATTERN.match(os.path.basename(filename)):
             try:
                 # Delete the file
                 logging.info(f"Deleting temparary file {filename} ...")
@@ -64,12 +115,45 @@ def delete_temp_files(directory):
                 send_to_zabbix(error_msg)
 
 
-def cvmfs_transaction(cvmfs_repo):
+# Repository state index: one cvmfs_server list per cycle instead of a list and a grep per operation.
+# Lines are like "repo01.infn.it (stratum0 / gw - in transaction)", the repository name is matched exactly
+def load_repo_states():
     try:
-        resp=subprocess.run(["cvmfs_server", "list"], check=True, capture_output=True)
-        resp1 = subprocess.run(["grep", cvmfs_repo], input=resp.stdout, capture_output=True)
-        if "transaction" not in resp1.stdout.decode('utf-8'):
-            res=subprocess.run(["cvmfs_server", "transaction", cvmfs_repo], capture_output=True,text=True, check=True)
+        res=subprocess.run(["cvmfs_server", "list"], capture_output=True, text=True, check=True)
+    except Exception as e:
+        error_msg=f"CVMFS list error, repository states not updated: {e}"
+        logging.error(error_msg)
+        send_to_zabbix(error_msg)
+        return
+    states = {}
+    for line in res.stdout.splitlines():
+        fields = line.split()
+        if fields:
+            states[fields[0]] = "transaction" in line
+    with REPO_STATE_LOCK:
+        REPO_IN_TRANSACTION.clear()
+        REPO_IN_TRANSACTION.update(states)
+
+
+def in_transaction(cvmfs_repo):
+    with REPO_STATE_LOCK:
+        return REPO_IN_TRANSACTION.get(cvmfs_repo, False)
+
+
+# Keep the index up to date when a transaction is opened, published or aborted
+def set_in_transaction(cvmfs_repo, state):
+    with REPO_STATE_LOCK:
+        REPO_IN_TRANSACTION[cvmfs_repo] = state
+
+
+# lease_path: sub-path of the repository leased from the gateway, e.g. software/oidc-agent_5.1.0, the whole repository if empty.
+# A transaction already open, e.g. left by a previous run, is reused whatever its lease
+def cvmfs_transaction(cvmfs_repo, lease_path=""):
+    try:
+        if not in_transaction(cvmfs_repo):
+            with CVMFS_SERVER_SECONDS.time(repo=cvmfs_repo, command="transaction"):
+                res=subprocess.run(["cvmfs_server", "transaction", f"{cvmfs_repo}/{lease_path}" if lease_path else cvmfs_repo], capture_output=True,text=True, check=True)
+            set_in_transaction(cvmfs_repo, True)
             logging.info(f"{res.stdout}")
             if res.stderr:
                 logging.error(f"{res.stderr}")   
@@ -77,23 +161,21 @@ def cvmfs_transaction(cvmfs_repo):
         error_msg=f"CVMFS transaction ERROR for {cvmfs_repo} repository: {e}, aborting transaction..."
         logging.error(error_msg)
         send_to_zabbix(error_msg)
-        # CVMFS ABORT in case of error
-        res=subprocess.run(["cvmfs_server", "abort", "-f", cvmfs_repo], capture_output=True,text=True,check=False)
-        logging.info(f"{res.stdout}")
-        if res.stderr:
-            error_msg=f"CVMFS abort error in cvmfs_repo_sync() function: {res.stderr}"
-            logging.error(error_msg)
-            send_to_zabbix(error_msg)
+        cvmfs_abort(cvmfs_repo, "cvmfs_transaction")
 
 
 # Create a CVMFS repository writable from publisher via gateway
 def create_repo_publisher(repo_name):
+    if repo_registry.is_created(repo_name):
+        return True
     cmd = f'cvmfs_server mkfs -w {CVMFS_SERVER_URL}{repo_name} \
     -u gw,/srv/cvmfs/{repo_name}/data/txn,{CVMFS_UP_STORAGE} \
     -k /data/cvmfs/{repo_name}/keys -o `whoami` {repo_name}'
     try:
-       subprocess.run(cmd, shell=True, capture_output=True, check=True)
+       with CVMFS_SERVER_SECONDS.time(repo=repo_name, command="mkfs"):
+           subprocess.run(cmd, shell=True, capture_output=True, check=True)
        logging.info(f'CVMFS repository {repo_name} successfully created.')
+       repo_registry.register(repo_name)
        # Delete CVMFS repo keys from /data/cvmfs/{repo_name}/keys/
        # CVMFS repo keys cannot be taken from Vault because the sync process down not know if the repo is personal or group, while the publisher has this information from the message received from
        shutil.rmtree(f'/data/cvmfs/{repo_name}/keys/')
@@ -104,6 +186,7 @@ def create_repo_publisher(repo_name):
         stderr_output = e.stderr.decode()
         # Case repo already exists
         if "already exists" in stderr_output:
+            repo_registry.register(repo_name)
             return True
         else:
             send_to_zabbix(error_msg)
@@ -115,107 +198,464 @@ def create_repo_publisher(repo_name):
         return False
 
 
-def cvmfs_repo_sync():                                  # my_cvmfs_path=/data/cvmfs , cvmfs_path=/cvmfs
-    for cvmfs_repo in os.listdir(my_cvmfs_path):        # cvmfs_repo=repo01.infn.it    
-        folder_path  = os.path.join(my_cvmfs_path, cvmfs_repo)
-        cvmfs_folder = os.path.join(cvmfs_path, cvmfs_repo)        
-        if os.path.isdir(folder_path):
-            # Check files in /data/cvmfs/reponame folder and move them into the corresponding CVMFS repository
-            files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
-            if files:
-                logging.info(f"Syncronization process for CVMFS repository {cvmfs_repo} started.")
-                try:
-                    create_repo_publisher(cvmfs_repo)
-                    cvmfs_transaction(cvmfs_repo)               
-                    # Create directory in the repository if it does not exist
-                    if not os.path.exists(cvmfs_folder):
-                        logging.info(f"Creating {cvmfs_folder} directory.")
-                        os.makedirs(cvmfs_folder)
-                    # Copy files in CVMFS dir
-                    for file_name in files:
-                        file_path = os.path.join(folder_path, file_name)
-                        logging.info(f"Copying {file_name} in {cvmfs_folder} ...")
-                        shutil.copy(file_path, cvmfs_folder)
-                    logging.info(f"Copy operation finished. CVMFS publish for {cvmfs_folder} starting ...")
-                    # Check if temporary or multipart files are present in the directory
-                    delete_temp_files(cvmfs_folder)                   
-                    # CVMFS PUBLISH
-                    res=subprocess.run(["cvmfs_server", "publish", cvmfs_repo], capture_output=True,text=True,check=True)
-                    logging.info(f"{res.stdout}")
-                    if res.stderr:
-                        logging.error(f"CVMFS publish for {cvmfs_folder} error: {res.stderr}")
-                    else:
-                        logging.info(f"CVMFS publish for {cvmfs_repo} successfully completed.")                       
-                        # Delete files from /data/cvmfs/repo only after publishing successfully finished
-                        for file_name in files:
-                            os.remove(os.path.join(folder_path, file_name))
-                            logging.info(f"Deleted: /data{cvmfs_folder}/{file_name}.")
-                    logging.info(f"Syncronization process for {cvmfs_repo} CVMFS repository successfully completed.")
-                except subprocess.CalledProcessError as e:
-                    error_msg=f"CVMFS transaction ERROR for {cvmfs_repo} repository: {e}, aborting transaction..."
-                    logging.error(error_msg)
-                    send_to_zabbix(error_msg)
-                    # CVMFS ABORT in case of error
-                    res=subprocess.run(["cvmfs_server", "abort", "-f", cvmfs_repo], capture_output=True,text=True,check=False)
-                    logging.info(f"{res.stdout}")
-                    if res.stderr:
-                       error_msg=f"CVMFS abort error in cvmfs_repo_sync() function: {res.stderr}"
-                       logging.error(error_msg)
-                       send_to_zabbix(error_msg)
-                except Exception as e:
-                    error_msg=f"Unexpected error in cvmfs_repo_sync() function: {e}"
-                    logging.error(error_msg)
-                    send_to_zabbix(error_msg)
-                    # CVMFS ABORT in case of error
-                    res=subprocess.run(["cvmfs_server", "abort", "-f", cvmfs_repo], capture_output=True,text=True,check=False)
-                    logging.info(f"{res.stdout}")
-                    if res.stderr:
-                       error_msg=f"CVMFS abort error in cvmfs_repo_sync() function: {res.stderr}"
-                       logging.error(error_msg)
-                       send_to_zabbix(error_msg)         
-            # CASE files to DELETE
-            files_to_delete = my_cvmfs_path + "/" + cvmfs_repo + "/to_delete/"  + cvmfs_repo.split('.')[0] + "-infn-it.txt"
-            if os.path.exists(files_to_delete) and (os.path.getsize(files_to_delete) > 0):  # check file existance and not empty
-                logging.info(f"Starting removing files for {cvmfs_repo} CVMFS repository ..")
-                delete_cvmfs_files(files_to_delete,cvmfs_repo)
-            # CASE .tar files to EXTRACT
-            to_extract_path = my_cvmfs_path + "/" + cvmfs_repo + "/to_extract/"
-            if os.path.isdir(to_extract_path) and os.listdir(to_extract_path):    
-                   tar_files = [f for f in os.listdir(to_extract_path) if os.path.isfile(os.path.join(to_extract_path, f))]
-                   cvmfs_extract(cvmfs_repo,tar_files)  
-
-
-# This function deletes files written in the file to_delete_file and if the operation is successfull, remove the line in the file
-def delete_cvmfs_files(to_delete_file,cvmfs_repo):         
-         with open(to_delete_file, "r") as f:
-              files = f.readlines()           
-         remaining_files = []              
-         try:
-            create_repo_publisher(cvmfs_repo)
-            # CVMFS transaction
-            cvmfs_transaction(cvmfs_repo)
-            for file in files:
-             file_path = file.strip()     
-             # CASE deleting .tar file                                                             # file_path=/cvmfs/repo01.infn.it/oidc-agent_5.1.0.tar
-             if file_path.endswith('.tar'):
+# Record the changes of the repositories in repos, all the /data/cvmfs folders if None, then start the synchronizations due.
+# A full scan counts as changes already quiet, so that it does not delay the repositories without recent events
+def cvmfs_repo_sync(repos=None):                       # my_cvmfs_path=/data/cvmfs , cvmfs_path=/cvmfs
+    change_time = time.monotonic() - (QUIET_PERIOD if repos is None else 0)
+    for cvmfs_repo in (os.listdir(my_cvmfs_path) if repos is None else repos):        # cvmfs_repo=repo01.infn.it
+        times = PENDING_REPOS.setdefault(cvmfs_repo, [change_time, change_time])
+        times[1] = max(times[1], change_time)
+    return schedule_due()
+
+
+# Debounced publish: a repository is synchronized QUIET_PERIOD seconds after its last change and MIN_PUBLISH_INTERVAL seconds
+# after its last publish, or anyway MAX_PUBLISH_DELAY seconds after its first change or with MAX_PENDING_CHANGES journal operations.
+# Different repositories are synchronized concurrently by the SYNC_EXECUTOR workers, a repository is never synchronized twice at the same time.
+# The scheduler state is only changed by the main thread, the workers report the end of their cycles through COMPLETED_SYNCS.
+# Returns the seconds before the next repository is due or the next check of the running cycles, None if nothing is waiting
+def schedule_due():
+    collect_completed()
+    now = time.monotonic()
+    due, next_due = [], None
+    for cvmfs_repo, (first_change, last_change) in PENDING_REPOS.items():
+        if cvmfs_repo in RUNNING_REPOS:
+            continue
+        due_time = min(max(last_change + QUIET_PERIOD, LAST_PUBLISH.get(cvmfs_repo, 0) + MIN_PUBLISH_INTERVAL),
+                       first_change + MAX_PUBLISH_DELAY)
+        if due_time <= now or pending_changes(cvmfs_repo) >= MAX_PENDING_CHANGES:
+            due.append(cvmfs_repo)
+            continue
+        next_due = due_time if next_due is None else min(next_due, due_time)
+    if due:
+        load_repo_states()
+    for cvmfs_repo in due:
+        del PENDING_REPOS[cvmfs_repo]
+        PENDING_COUNTS.pop(cvmfs_repo, None)
+        submit_sync(cvmfs_repo)
+    if RUNNING_REPOS:
+        next_due = now + SCHEDULE_TICK if next_due is None else min(next_due, now + SCHEDULE_TICK)
+    return None if next_due is None else next_due - now
+
+
+# Journal operations of a waiting repository, counted again only when the repository changed since the last count,
+# e.g. the consumer wrote its journal, not at every check of the scheduler
+def pending_changes(cvmfs_repo):
+    last_change = PENDING_REPOS[cvmfs_repo][1]
+    if PENDING_COUNTS.get(cvmfs_repo, (None, 0))[0] != last_change:
+        PENDING_COUNTS[cvmfs_repo] = (last_change, repo_journal.count(os.path.join(my_cvmfs_path, cvmfs_repo)))
+    return PENDING_COUNTS[cvmfs_repo][1]
+
+
+def submit_sync(cvmfs_repo):
+    future = SYNC_EXECUTOR.submit(sync_cycle, cvmfs_repo)
+    RUNNING_REPOS[cvmfs_repo] = future
+    future.add_done_callback(lambda f: sync_done(cvmfs_repo, f))
+
+
+def sync_cycle(cvmfs_repo):
+    with SYNC_CYCLE_SECONDS.time(repo=cvmfs_repo):
+        return sync_repository(cvmfs_repo)
+
+
+# Done callback of a sync cycle, run by the worker or by submit_sync itself if the cycle already ended: it only queues the result
+def sync_done(cvmfs_repo, future):
+    COMPLETED_SYNCS.put((cvmfs_repo, future))
+
+
+# Fairness: a repository with more than MAX_CHANGES_PER_CYCLE pending changes is due again at once, behind the other repositories
+# already due. The repositories changed while running are synchronized when due
+def collect_completed():
+    while True:
+        try:
+            cvmfs_repo, future = COMPLETED_SYNCS.get_nowait()
+        except queue.Empty:
+            return
+        del RUNNING_REPOS[cvmfs_repo]
+        if future.exception() is not None:
+            error_msg=f"Unexpected error in cvmfs_repo_sync() function for {cvmfs_repo}: {future.exception()}"
+            logging.error(error_msg)
+            send_to_zabbix(error_msg)
+        elif future.result():
+            now = time.monotonic()
+            times = PENDING_REPOS.setdefault(cvmfs_repo, [now, now])
+            times[0] = min(times[0], now - MAX_PUBLISH_DELAY)
+
+
+# Returns True if the repository has pending work left for the next cycle
+def sync_repository(cvmfs_repo):
+    folder_path  = os.path.join(my_cvmfs_path, cvmfs_repo)
+    if not os.path.isdir(folder_path):
+        return False
+    import_legacy_deletes(folder_path, cvmfs_repo)
+    if cvmfs_repo not in CATALOGS_CONFIGURED and CATALOG_POLICY == 'autocatalogs' and repo_registry.configured(cvmfs_repo):
+        configure_autocatalogs(cvmfs_repo)
+    changes = plan_changes(cvmfs_repo, folder_path)
+    if changes["files"] or changes["deletes"] or changes["tars"] or changes["bundle_deletes"]:
+        LAST_PUBLISH[cvmfs_repo] = time.monotonic()
+    if changes["files"] or changes["deletes"]:
+        logging.info(f"Syncronization process for CVMFS repository {cvmfs_repo} started: {len(changes['files'])} files to copy, {len(changes['deletes'])} to delete.")
+        apply_changes(cvmfs_repo, changes)
+    # cvmfs_server ingest opens its own transaction: all the tarballs are ingested and the removed bundles deleted
+    # by a single ingest after the publish
+    if changes["tars"] or changes["bundle_deletes"]:
+        cvmfs_extract(cvmfs_repo, changes["tars"], changes["puts"], changes["staged_tars"], changes["bundle_deletes"])
+    return changes["more"]
+
+
+# Change planner: gather the pending uploads, deletions and tarballs of the repository, at most MAX_CHANGES_PER_CYCLE in total.
+# Returns a dict with files (to copy), deletes (journal entries), tars (to ingest), bundle_deletes (journal entries of the removed
+# tarballs, deleted by the ingest), puts (pending uploads by path), staged and staged_tars (scan of the staged files and tarballs,
+# checked before removing them) and more (True if changes were left for the next cycle)
+def plan_changes(cvmfs_repo, folder_path):
+    entries = repo_journal.pending(folder_path)
+    puts = {entry[1]: entry for entry in entries if entry[2] == repo_journal.PUT}
+    # Uploads already published or replaced: the staged file is not there anymore. Tarballs with a source are streamed from S3
+    repo_journal.complete(folder_path, [entry for path, entry in puts.items() if not entry[4] and not os.path.exists(staged_path(folder_path, path))])
+    # Check files in /data/cvmfs/reponame and its subfolders and move them into the corresponding CVMFS repository
+    staged = scan_staged(folder_path, EXCLUDED_FOLDERS)
+    # Temporary or multipart files never enter the change set, they are deleted from the staging area when stale
+    temp_files = [f for f in staged if TEMP_FILE_PATTERN.match(os.path.basename(f))]
+    delete_temp_files(folder_path, [f for f in temp_files if time.time_ns() - staged[f][1] > TEMP_FILE_MAX_AGE * 10**9])
+    files = sorted(set(staged) - set(temp_files))
+    # Files identical to the published ones are dropped from the change set
+    identical = [f for f in files if published_identical(cvmfs_repo, f, staged[f], puts.get(f))]
+    if identical:
+        drop_identical(cvmfs_repo, folder_path, identical, puts, staged)
+        files = sorted(set(files) - set(identical))
+    STAGED_FILES.set(len(files), repo=cvmfs_repo)
+    STAGED_BYTES.set(sum(staged[f][0] for f in files), repo=cvmfs_repo)
+    deletes = [entry for entry in entries if entry[2] == repo_journal.DELETE]
+    staged_tars = scan_staged(os.path.join(folder_path, "to_extract"), [])
+    tar_files = sorted(set(staged_tars) | set(path for path, entry in puts.items() if entry[4]))
+    # Deletions first: they are the oldest operations of the journal
+    budget = MAX_CHANGES_PER_CYCLE
+    changes = {"deletes": deletes[:budget], "puts": puts, "staged": staged, "staged_tars": staged_tars}
+    budget -= len(changes["deletes"])
+    changes["files"] = files[:budget]
+    budget -= len(changes["files"])
+    changes["tars"] = tar_files[:budget]
+    # A removed bundle is deleted by the ingest, unless a tarball of this ingest has the same bundle name:
+    # then it is deleted in the transaction, published before the ingest
+    ingested = set(bundle_path(tar_file) for tar_file in changes["tars"])
+    changes["bundle_deletes"] = [entry for entry in changes["deletes"] if tarball.is_tarball(os.path.basename(entry[1])) and bundle_path(entry[1]) not in ingested]
+    changes["deletes"] = [entry for entry in changes["deletes"] if entry not in changes["bundle_deletes"]]
+    changes["more"] = len(deletes) + len(files) + len(tar_files) > MAX_CHANGES_PER_CYCLE
+    return changes
+
+
+# Compare a staged file with the published one without reading either: size, then the content hash exported by the CVMFS client
+# in the user.hash attribute against the hash recorded by the consumer. The recorded hash is used only if the Put was recorded
+# after the staged file was written, i.e. it is not the hash of a previous download of the same path
+def published_identical(cvmfs_repo, path, size_mtime, entry):
+    if not entry or not entry[5] or entry[3] * 10**9 < size_mtime[1]:
+        return False
+    published = os.path.join(cvmfs_path, cvmfs_repo, path)
+    try:
+        if not os.path.isfile(published) or os.path.getsize(published) != size_mtime[0]:
+            return False
+        return os.getxattr(published, PUBLISHED_HASH_XATTR).decode().strip() == entry[5]
+    except OSError:
+        return False
+
+
+def drop_identical(cvmfs_repo, folder_path, identical, puts, staged):
+    dropped = []
+    for path in identical:
+        if not remove_staged(os.path.join(folder_path, path), staged[path]):
+            continue
+        logging.info(f"{path} identical to the published file in {cvmfs_repo}, not published again.")
+        dropped.append(path)
+    repo_journal.complete(folder_path, [puts[path] for path in dropped if path in puts])
+    remove_empty_folders(folder_path, dropped)
+    SKIPPED_FILES.inc(len(dropped), repo=cvmfs_repo)
+
+
+# Narrowest lease covering the change set: the deepest existing folder containing all the changed paths.
+# Changes in different top folders, or in the repository root, need the whole repository ("")
+def changes_lease_path(cvmfs_repo, changes):
+    paths = list(changes["files"])
+    for entry in changes["deletes"]:
+        paths.append(bundle_path(entry[1]) if tarball.is_tarball(os.path.basename(entry[1])) else entry[1])
+    if not paths:
+        return ""
+    lease_path = os.path.commonpath([os.path.dirname(path) for path in paths])
+    while lease_path and not os.path.isdir(os.path.join(cvmfs_path, cvmfs_repo, lease_path)):
+        lease_path = os.path.dirname(lease_path)
+    return lease_path
+
+
+# Nested catalogs split by entry count by cvmfs_server publish and ingest, set in the server configuration of the repository
+def configure_autocatalogs(cvmfs_repo):
+    server_conf = os.path.join(repo_registry.SERVER_CONFIG_DIR, cvmfs_repo, "server.conf")
+    settings = {"CVMFS_AUTOCATALOGS": "true", "CVMFS_AUTOCATALOGS_MAX_WEIGHT": str(AUTOCATALOGS_MAX_WEIGHT)}
+    try:
+        with open(server_conf) as f:
+            lines = f.read().splitlines()
+        new_lines = [line for line in lines if line.split('=', 1)[0] not in settings] + [f"{k}={v}" for k, v in settings.items()]
+        if sorted(new_lines) != sorted(lines):
+            with open(server_conf + ".tmp", "w") as f:
+                f.write("\n".join(new_lines) + "\n")
+            os.replace(server_conf + ".tmp", server_conf)
+            logging.info(f"Autocatalogs enabled for {cvmfs_repo}, max weight {AUTOCATALOGS_MAX_WEIGHT}.")
+        CATALOGS_CONFIGURED.add(cvmfs_repo)
+    except Exception as e:
+        error_msg=f"Autocatalogs configuration error for {cvmfs_repo}: {e}"
+        logging.error(error_msg)
+        send_to_zabbix(error_msg)
+
+
+# .cvmfsdirtab of the bundle policy: cvmfs_server publish creates a nested catalog for each folder matching DIRTAB.
+# Written in the open transaction, only if missing or different
+def write_dirtab(cvmfs_repo):
+    dirtab = os.path.join(cvmfs_path, cvmfs_repo, ".cvmfsdirtab")
+    content = "\n".join(DIRTAB) + "\n"
+    try:
+        with open(dirtab) as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = None
+    if current != content:
+        with open(dirtab, "w") as f:
+            f.write(content)
+        logging.info(f"{dirtab} written: {', '.join(DIRTAB)}.")
+
+
+# Staged files under root as {relative path: (size, mtime, inode)}, hidden files (downloads in progress) and the excluded folders of root skipped.
+# Only the folders whose mtime changed since the previous scan are listed again, the others are only stat()ed
+def scan_staged(root, excluded):
+    old_index = STAGING_INDEX.get(root, {})
+    index = {}
+    staged = {}
+    folders = [""]
+    while folders:
+        folder = folders.pop()
+        path = os.path.join(root, folder)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        entry = old_index.get(folder)
+        if entry is None or entry[0] != mtime:
+            files, subfolders = {}, []
+            try:
+                with os.scandir(path) as it:
+                    for dir_entry in it:
+                        if dir_entry.name.startswith('.') or (not folder and dir_entry.name in excluded):
+                            continue
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            subfolders.append(dir_entry.name)
+                        elif dir_entry.is_file(follow_symlinks=False):
+                            stat = dir_entry.stat(follow_symlinks=False)
+                            files[dir_entry.name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            except FileNotFoundError:
+                continue
+            # A folder changed within the mtime granularity could change again with the same mtime: listed again next time
+            entry = (mtime if time.time_ns() - mtime > 2 * 10**9 else None, files, subfolders)
+        index[folder] = entry
+        for name, scanned in entry[1].items():
+            staged[os.path.join(folder, name)] = scanned
+        folders.extend(os.path.join(folder, subfolder) for subfolder in entry[2])
+    STAGING_INDEX[root] = index
+    return staged
+
+
+# Copy the files and apply the deletions of the change set in a single transaction, published once
+def apply_changes(cvmfs_repo, changes):
+    folder_path  = os.path.join(my_cvmfs_path, cvmfs_repo)
+    cvmfs_folder = os.path.join(cvmfs_path, cvmfs_repo)
+    try:
+        create_repo_publisher(cvmfs_repo)
+        lease_path = changes_lease_path(cvmfs_repo, changes) if SUBPATH_LEASES else ""
+        if lease_path:
+            logging.info(f"Leasing {cvmfs_repo}/{lease_path} for the transaction.")
+        cvmfs_transaction(cvmfs_repo, lease_path)
+        # Create directory in the repository if it does not exist
+        if not os.path.exists(cvmfs_folder):
+            logging.info(f"Creating {cvmfs_folder} directory.")
+            os.makedirs(cvmfs_folder)
+        # The .cvmfsdirtab in the repository root needs a lease on the whole repository
+        if CATALOG_POLICY == 'bundle' and not lease_path:
+            write_dirtab(cvmfs_repo)
+        # Copy files in CVMFS dir, recreating the folders of the staging area
+        for file_name in changes["files"]:
+            file_path = os.path.join(folder_path, file_name)
+            logging.info(f"Copying {file_name} in {cvmfs_folder} ...")
+            os.makedirs(os.path.dirname(os.path.join(cvmfs_folder, file_name)), exist_ok=True)
+            transfer_file(file_path, os.path.join(cvmfs_folder, file_name))
+        deleted = delete_cvmfs_files(changes["deletes"], cvmfs_repo)
+        logging.info(f"Changes applied. CVMFS publish for {cvmfs_folder} starting ...")
+        # CVMFS PUBLISH
+        with CVMFS_SERVER_SECONDS.time(repo=cvmfs_repo, command="publish"):
+            res=subprocess.run(["cvmfs_server", "publish", cvmfs_repo], capture_output=True,text=True,check=True)
+        set_in_transaction(cvmfs_repo, False)
+        logging.info(f"{res.stdout}")
+        if res.stderr:
+            error_msg=f"CVMFS publish for {cvmfs_repo} error: {res.stderr}"
+            logging.error(error_msg)
+            send_to_zabbix(error_msg)
+            return
+        logging.info(f"CVMFS publish for {cvmfs_repo} successfully completed.")
+        # Delete files from /data/cvmfs/repo only after publishing successfully finished
+        # A file replaced while the transaction was open is kept with its Put: only the previous version was published
+        removed = [f for f in changes["files"] if remove_staged(os.path.join(folder_path, f), changes["staged"][f])]
+        for file_name in removed:
+            logging.info(f"Deleted: /data{cvmfs_folder}/{file_name}.")
+        remove_empty_folders(folder_path, removed)
+        puts = changes["puts"]
+        repo_journal.complete(folder_path, [puts[f] for f in removed if f in puts] + deleted)
+        logging.info(f"Syncronization process for {cvmfs_repo} CVMFS repository successfully completed.")
+    except subprocess.CalledProcessError as e:
+        error_msg=f"CVMFS transaction ERROR for {cvmfs_repo} repository: {e}, aborting transaction..."
+        logging.error(error_msg)
+        send_to_zabbix(error_msg)
+        cvmfs_abort(cvmfs_repo, "apply_changes")
+    except Exception as e:
+        error_msg=f"Unexpected error in apply_changes() function: {e}"
+        logging.error(error_msg)
+        send_to_zabbix(error_msg)
+        cvmfs_abort(cvmfs_repo, "apply_changes")
+
+
+# Remove a staged file only if it is still the one found by the scan: a file replaced in the meantime by a new download
+# (another inode or mtime) is kept for the next cycle, with its new journal operation. Returns True if the file was removed
+def remove_staged(file_path, scanned):
+    try:
+        stat = os.stat(file_path)
+        if (stat.st_mtime_ns, stat.st_ino) != scanned[1:3]:
+            logging.info(f"{file_path} replaced since the scan, kept for the next cycle.")
+            return False
+        os.remove(file_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+# Remove the staging folders left empty by the published files, up to root excluded, so that the scans and the inotify watches
+# do not grow with every folder ever uploaded. A folder which got a new file in the meantime is not empty and is kept
+def remove_empty_folders(root, paths):
+    for folder in sorted(set(os.path.dirname(path) for path in paths), key=lambda f: f.count(os.sep), reverse=True):
+        while folder:
+            try:
+                os.rmdir(os.path.join(root, folder))
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+
+# Transfer a staged file into the open transaction with the cheapest primitive available: a hardlink on the same filesystem,
+# otherwise a reflink, copy_file_range or sendfile done by the kernel, with shutil as last resort.
+# The staged file is kept, only as a link when possible, until the publish succeeds
+def transfer_file(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+    methods = TRANSFER_FUNCTIONS[TRANSFER_METHODS.get(devices, 0):]
+    for i, method in enumerate(methods):
+        try:
+            method(src, dst)
+        except OSError as e:
+            if method is copyfile or e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            if os.path.lexists(dst):
+                os.remove(dst)
+            # Not supported between these filesystems, not tried again
+            TRANSFER_METHODS[devices] = TRANSFER_FUNCTIONS.index(methods[i + 1])
+            continue
+        shutil.copymode(src, dst)
+        TRANSFERS.inc(method=method.__name__)
+        return
+
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+
+def reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_file_range(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+            pass
+
+
+def sendfile(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        while os.sendfile(fdst.fileno(), fsrc.fileno(), None, 1 << 30):
+            pass
+
+
+def copyfile(src, dst):
+    shutil.copyfile(src, dst)
+
+
+TRANSFER_FUNCTIONS          = [hardlink, reflink, copy_file_range, sendfile, copyfile]
+if not hasattr(os, "copy_file_range"):                 # Python < 3.8
+    TRANSFER_FUNCTIONS.remove(copy_file_range)
+
+
+# CVMFS ABORT in case of error
+def cvmfs_abort(cvmfs_repo, function_name):
+    res=subprocess.run(["cvmfs_server", "abort", "-f", cvmfs_repo], capture_output=True,text=True,check=False)
+    set_in_transaction(cvmfs_repo, False)
+    logging.info(f"{res.stdout}")
+    if res.stderr:
+       error_msg=f"CVMFS abort error in {function_name} function: {res.stderr}"
+       logging.error(error_msg)
+       send_to_zabbix(error_msg)
+
+
+# Folder of a tarball in the repository: the tarballs are ingested in software/   # path=oidc-agent_5.1.0.tar.gz
+def bundle_path(path):
+    return os.path.join("software", tarball.bundle_name(os.path.basename(path)))   # bundle path=software/oidc-agent_5.1.0
+
+
+# Staged file of an upload recorded in the repository journal, tarballs are staged in to_extract
+def staged_path(folder_path, path):
+    if tarball.is_tarball(os.path.basename(path)):
+        return os.path.join(folder_path, "to_extract", path)
+    return os.path.join(folder_path, path)
+
+
+# Deletions written by the previous versions in to_delete/<repo>-infn-it.txt are moved into the repository journal
+def import_legacy_deletes(folder_path, cvmfs_repo):
+    to_delete_file = folder_path + "/to_delete/" + cvmfs_repo.split('.')[0] + "-infn-it.txt"
+    if os.path.exists(to_delete_file):
+        with open(to_delete_file, "r") as f:
+            for line in f:
+                if line.strip():                                                    # line=/cvmfs/repo01.infn.it/NETCDC01
+                    repo_journal.record(folder_path, line.strip()[len(cvmfs_path + cvmfs_repo):].lstrip('/'), repo_journal.DELETE)
+        os.remove(to_delete_file)
+        logging.info(f"{to_delete_file} imported in the {cvmfs_repo} repository journal.")
+
+
+# This function deletes the files of the pending DELETE operations of the repository journal, inside the transaction
+# opened by apply_changes. Returns the entries deleted, removed from the journal after the publish
+def delete_cvmfs_files(entries,cvmfs_repo):
+         deleted = []
+         for entry in entries:
+             file_path = os.path.join(cvmfs_path, cvmfs_repo, entry[1])
+             # CASE deleting a tarball, plain or compressed                                        # file_path=/cvmfs/repo01.infn.it/oidc-agent_5.1.0.tar.gz
+             if tarball.is_tarball(os.path.basename(file_path)):
                 try:
-                   # extract folder name
-                   folder_name = os.path.basename(file_path).rsplit('.', 1)[0]                     # folder_name=oidc-agent_5.1.0
-                   # define folder path
-                   folder_path = os.path.join(os.path.dirname(file_path), "software", folder_name) # folder_path=/cvmfs/repo01.infn.it/software/oidc-agent_5.1.0/
+                   # Only when a tarball with the same bundle name is ingested in this cycle, otherwise cvmfs_server ingest -d deletes it
+                   folder_path = os.path.join(cvmfs_path, cvmfs_repo, bundle_path(entry[1]))      # folder_path=/cvmfs/repo01.infn.it/software/oidc-agent_5.1.0/
                    if os.path.exists(folder_path) and os.path.isdir(folder_path):
                       # The entire content in /cvmfs/reponame/software/ is to be deleted, not the software dir
-                      shutil.rmtree(folder_path)                                                   # to value cvmfs_server ingest -d
+                      shutil.rmtree(folder_path)
                       logging.info(f"Deleted: {folder_path}")
                    else:
                       # 'File not found' is not considered as an error, it is only logged in the log file
                       logging.info(f"Folder {folder_path} or filename not found, nothing to delete.")
+                   deleted.append(entry)
                 except Exception as e:
                    error_msg=f"Unexpected error in delete_cvmfs_files function: {e}"
                    logging.error(error_msg)
                    send_to_zabbix(error_msg)
-                   remaining_files.append(file)         # Keep the line if deletion fails
-             else:  
+                   # The operation stays in the journal if deletion fails
+             else:
              # CASE deleting other types of files, e.g. file_path=/cvmfs/repo01.infn.it/NETCDC01
                try:
                  if os.path.exists(file_path):
@@ -224,84 +664,273 @@ def delete_cvmfs_files(to_delete_file,cvmfs_repo):
                  else:
                    # 'File not found' is not considered an error, it is only logged in the log file
                    logging.info(f"File not found, skipping: {file_path}")
+                 deleted.append(entry)
                except Exception as e:
                    error_msg=f"Unexpected error in delete_cvmfs_files function: {e}"
                    logging.error(error_msg)
                    send_to_zabbix(error_msg)
-                   remaining_files.append(file)  # Keep the line if deletion fails       
-            # CVMFS publish
-            res=subprocess.run(["cvmfs_server", "publish", cvmfs_repo], capture_output=True,text=True,check=True)
-            logging.info(f"{res.stdout}")
-            if res.stderr:
-                error_msg=f"CVMFS publish for {cvmfs_repo} error: {res.stderr}"     
+                   # The operation stays in the journal if deletion fails
+         return deleted
+
+
+# Reads ahead of the consumer of a stream in a background thread, up to READ_AHEAD_MB, so that the S3 download
+# and the ingest overlap instead of waiting for each other
+class ReadAhead:
+
+    def __init__(self, body):
+        self.body = body
+        self.chunks = queue.Queue(maxsize=max(READ_AHEAD_MB * 1024 * 1024 // READ_AHEAD_CHUNK, 1))
+        self.chunk = b""
+        self.offset = 0
+        self.eof = False
+        self.error = None
+        self.closed = False
+        threading.Thread(target=self.fill, name="read-ahead", daemon=True).start()
+
+    def fill(self):
+        try:
+            while not self.closed:
+                chunk = self.body.read(READ_AHEAD_CHUNK)
+                self.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self.error = e
+            self.put(b"")
+
+    # Waits for room in the queue, gives up once the reader closed the stream
+    def put(self, chunk):
+        while not self.closed:
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        parts = []
+        while not self.eof and size != 0:
+            if self.offset == len(self.chunk):
+                self.chunk, self.offset = self.chunks.get(), 0
+                if not self.chunk:
+                    self.eof = True
+                    if self.error:
+                        raise self.error
+                    break
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + size)
+            parts.append(self.chunk[self.offset:end])
+            size = size if size < 0 else size - (end - self.offset)
+            self.offset = end
+        return b"".join(parts)
+
+    def close(self):
+        self.closed = True
+        self.body.close()
+
+
+def parse_source(source):                                   # source=s3://repo01/cvmfs/oidc-agent_5.1.0.tar
+    return source[len("s3://"):].split('/', 1)
+
+
+# A staged tarball is read from the staging area, the others are streamed from their S3 source
+def open_tarball(cvmfs_repo, tar_file, puts):
+    tar_path = os.path.join(my_cvmfs_path, cvmfs_repo, "to_extract", tar_file)
+    if os.path.isfile(tar_path) or tar_file not in puts or not puts[tar_file][4]:
+        return open(tar_path, "rb")
+    bucket, key = parse_source(puts[tar_file][4])
+    body = S3.call('get_object', Bucket=bucket, Key=key)['Body']
+    logging.info(f"Streaming {tar_file} from s3://{bucket}/{key}.")
+    return ReadAhead(body) if READ_AHEAD_MB else body
+
+
+# Write the members of the tarballs as a single uncompressed tar stream into the stdin of cvmfs_server ingest,
+# compressed tarballs are decompressed on the fly in this thread or in a zstd process.
+# On error the ingest is killed before the stream is closed, so that a truncated stream is never published: the whole process group,
+# cvmfs_server being a shell script whose children read the stream too
+def write_tar_stream(cvmfs_repo, tar_files, puts, proc, errors):
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode="w|", format=tarfile.PAX_FORMAT, bufsize=TAR_BUFSIZE) as stream:
+            bundles = set()
+            for tar_file in tar_files:
+                source = open_tarball(cvmfs_repo, tar_file, puts)
+                try:
+                    with tarball.open_stream(source, tar_file, TAR_BUFSIZE) as tar:
+                        for member in tar:
+                            stream.addfile(member, tar.extractfile(member) if member.isfile() else None)
+                            if CATALOG_POLICY == 'bundle':
+                                add_catalog_marker(stream, member, bundles)
+                finally:
+                    source.close()
+    except Exception as e:
+        errors.append(e)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
+
+# Bundle policy: a .cvmfscatalog marker in each top folder of the tarballs, i.e. a nested catalog for each
+# software/<bundle> folder, added to the stream after the first member of the folder
+def add_catalog_marker(stream, member, bundles):
+    parts = [part for part in member.name.split('/') if part not in ('', '.')]
+    if not parts or (len(parts) == 1 and not member.isdir()) or parts[0] in bundles:
+        return
+    bundles.add(parts[0])
+    marker = tarfile.TarInfo(f"{parts[0]}/{CATALOG_MARKER}")
+    marker.mtime = member.mtime
+    marker.mode = 0o644
+    stream.addfile(marker, io.BytesIO(b""))
+
+
+# Ingest the tarballs and delete the bundle folders in delete_paths (relative to the repository root) with one cvmfs_server ingest,
+# i.e. one publish. The deletions are done on the catalogs, without unlinking every file through the union mount
+def ingest_tarballs(cvmfs_repo, tar_files, puts, delete_paths=()):
+    errors = []
+    delete_option = ["-d", ":".join(delete_paths)] if delete_paths else []
+    with CVMFS_SERVER_SECONDS.time(repo=cvmfs_repo, command="ingest"):
+        proc = subprocess.Popen(["cvmfs_server", "ingest", "-t", "-", "-b", "software/"] + delete_option + [cvmfs_repo],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        writer = threading.Thread(target=write_tar_stream, args=(cvmfs_repo, tar_files, puts, proc, errors), daemon=True)
+        writer.start()
+        output = proc.stdout.read().decode('utf-8', errors='replace')
+        proc.wait()
+        writer.join()
+    if errors:
+        raise errors[0]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, output=output)
+    logging.info(output)
+
+
+# Fallback of the streamed tarballs when their ingest fails, e.g. the repository is busy: they are downloaded in the
+# staging area, checked against the size of the S3 object, and the next attempts read them from there.
+# The staged tarballs are added to staged_tars. Returns the tarballs whose S3 object does not exist anymore
+def stage_tarballs(cvmfs_repo, tar_files, puts, staged_tars):
+    gone = []
+    for tar_file in tar_files:
+        tar_path = os.path.join(my_cvmfs_path, cvmfs_repo, "to_extract", tar_file)
+        if os.path.isfile(tar_path) or tar_file not in puts or not puts[tar_file][4]:
+            continue
+        bucket, key = parse_source(puts[tar_file][4])
+        temp_file = os.path.join(os.path.dirname(tar_path), f".{os.path.basename(tar_path)}.staging")
+        try:
+            size = S3.call('head_object', Bucket=bucket, Key=key)['ContentLength']
+            S3.call('download_file', bucket, key, temp_file)
+            if os.path.getsize(temp_file) != size:
+                raise Exception(f"{os.path.getsize(temp_file)} bytes downloaded instead of {size}")
+            os.replace(temp_file, tar_path)
+            stat = os.stat(tar_path)
+            staged_tars[tar_file] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            logging.info(f"{tar_file} staged in {cvmfs_repo}/to_extract after a failed streamed ingest.")
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+                # No ingest for an S3 non existing file. This case is not considered an error
+                logging.warning(f'The object {key} does not exist in the bucket {bucket}. Not ingested.')
+                repo_journal.complete(os.path.join(my_cvmfs_path, cvmfs_repo), [puts[tar_file]])
+                gone.append(tar_file)
+            else:
+                error_msg=f"Staging of {tar_file} for {cvmfs_repo} failed: {e}"
                 logging.error(error_msg)
                 send_to_zabbix(error_msg)
-            else:
-                logging.info(f"CVMFS publish for {cvmfs_repo} successfully completed.")
-            # Rewrite the file with remaining paths
-            with open(to_delete_file, "w") as f:
-                 f.writelines(remaining_files) 
-            # What is deleted is written before
-            logging.info(f"DELETE file operation for {cvmfs_repo} successfully completed.")
-         except subprocess.CalledProcessError as e:
-                    error_msg=f"CVMFS transaction ERROR for {cvmfs_repo} repository: {e}, aborting transaction."
-                    logging.error(error_msg)
-                    send_to_zabbix(error_msg)
-                    # CVMFS abort in case of error
-                    res=subprocess.run(["cvmfs_server", "abort", "-f", cvmfs_repo], capture_output=True,text=True,check=False)
-                    logging.info(f"{res.stdout}")
-                    if res.stderr:
-                       error_msg=f"CVMFS abort error in delete_cvmfs_files function: {res.stderr}"
-                       logging.error(error_msg)
-                       send_to_zabbix(error_msg)
-         except Exception as e:
-                    error_msg=f"Unexpected error: {e}"
-                    logging.error(error_msg)
-                    send_to_zabbix(error_msg)
+        except Exception as e:
+            error_msg=f"Staging of {tar_file} for {cvmfs_repo} failed: {e}"
+            logging.error(error_msg)
+            send_to_zabbix(error_msg)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    return gone
 
 
 # EXTRACT FUNTION
-def cvmfs_extract(cvmfs_repo, tar_files):   # cvmfs_repo= repo01.infn.it , tar_files=['oidc.tar']
+def cvmfs_extract(cvmfs_repo, tar_files, puts, staged_tars, bundle_deletes=()):   # cvmfs_repo= repo01.infn.it , tar_files=['oidc.tar'], puts=pending journal uploads,
+                                                                                  # staged_tars=scan of the staged tarballs
          my_cvmfs_repo_extract_path= my_cvmfs_path + "/" + cvmfs_repo + "/to_extract/"
-         for tar_file in tar_files:
-                logging.info(f"Extracting {tar_file} in {cvmfs_repo} started.")   
+         repo_path = os.path.join(my_cvmfs_path, cvmfs_repo)
+         # Bundles already missing from the repository are not passed to ingest -d
+         delete_paths = sorted(set(bundle_path(entry[1]) for entry in bundle_deletes if os.path.isdir(os.path.join(cvmfs_path, cvmfs_repo, bundle_path(entry[1])))))
+         if bundle_deletes and not delete_paths and not tar_files:
+             logging.info(f"Folders of the removed tarballs not found in {cvmfs_repo}, nothing to delete.")
+             repo_journal.complete(repo_path, bundle_deletes)
+             return
+         # All the tarballs and deletions together, then one by one if that fails so that a broken tarball does not hold back the others
+         batches = [(tar_files, delete_paths)]
+         if len(tar_files) + (1 if delete_paths else 0) > 1:
+             batches += [([tar_file], []) for tar_file in tar_files] + ([([], delete_paths)] if delete_paths else [])
+         gone = set()
+         for i, (batch, batch_deletes) in enumerate(batches):
+                batch = [tar_file for tar_file in batch if tar_file not in gone]
+                if not batch and not batch_deletes:
+                    continue
+                logging.info(f"Extracting {', '.join(batch)} and deleting {', '.join(batch_deletes)} in {cvmfs_repo} started.")
                 try:
                     # If the repo is in a transaction, it must be closed before ingestion . 
-                    resp=subprocess.run(["cvmfs_server", "list"], check=True, capture_output=True)
-                    resp1 = subprocess.run(["grep", cvmfs_repo], input=resp.stdout, capture_output=True)
-                    if "transaction" in resp1.stdout.decode('utf-8'):
-                       res=subprocess.run(["cvmfs_server", "publish", cvmfs_repo], capture_output=True, text=True, check=True)
+                    if in_transaction(cvmfs_repo):
+                       with CVMFS_SERVER_SECONDS.time(repo=cvmfs_repo, command="publish"):
+                           res=subprocess.run(["cvmfs_server", "publish", cvmfs_repo], capture_output=True, text=True, check=True)
+                       set_in_transaction(cvmfs_repo, False)
                        logging.info(f"{res.stdout}")
                        if res.stderr:
                           logging.error(f"{res.stderr}")                    
-                    # CVMFS ingest
-                    my_tar_file= my_cvmfs_repo_extract_path + tar_file          # my_tar_file= cvmfs/repo21.infn.it/to_extract/oidc-agent.5.1.0.tar
-                    subprocess.run(["cvmfs_server", "ingest", "-t", my_tar_file, "-b", "software/" , cvmfs_repo], capture_output=True, text=True, check=True)              
-                    # Delete .tar files
-                    os.remove(os.path.join(my_cvmfs_repo_extract_path, tar_file))
-                    logging.info(f"CVMFS server ingest process for {tar_file} in {cvmfs_repo} successfully completed.")
+                    # CVMFS ingest of /data/cvmfs/repo21.infn.it/to_extract/oidc-agent.5.1.0.tar or of its S3 stream
+                    ingest_tarballs(cvmfs_repo, batch, puts, batch_deletes)
+                    # Delete the staged tarballs, unless replaced by a new upload during the ingest
+                    kept = [tar_file for tar_file in batch if tar_file in staged_tars and not remove_staged(my_cvmfs_repo_extract_path + tar_file, staged_tars[tar_file])]
+                    remove_empty_folders(my_cvmfs_repo_extract_path, batch)
+                    completed = [puts[f] for f in batch if f in puts and f not in kept]
+                    if i == 0 or batch_deletes:
+                        completed += list(bundle_deletes)
+                    repo_journal.complete(repo_path, completed)
+                    logging.info(f"CVMFS server ingest process for {', '.join(batch + batch_deletes)} in {cvmfs_repo} successfully completed.")
+                    if i == 0:
+                        return
                 except subprocess.CalledProcessError as e:
-                    error_msg=f"CVMFS server ingest ERROR for {tar_file} in {cvmfs_repo}: {e}. Aborting transaction..."
+                    error_msg=f"CVMFS server ingest ERROR for {', '.join(batch + batch_deletes)} in {cvmfs_repo}: {e} {e.output}. Aborting transaction..."
                     logging.error(error_msg)
                     send_to_zabbix(error_msg)
-                    # CVMFS abort in case of error
-                    res=subprocess.run(["cvmfs_server", "abort", "-f", cvmfs_repo], capture_output=True, text=True, check=False)
-                    logging.info(f"{res.stdout}")
-                    if res.stderr:
-                       error_msg=f"CVMFS abort error in cvmfs_extract function: {res.stderr}"
-                       logging.error(error_msg)
-                       send_to_zabbix(error_msg)
+                    cvmfs_abort(cvmfs_repo, "cvmfs_extract")
+                    gone.update(stage_tarballs(cvmfs_repo, batch, puts, staged_tars))
                 except Exception as e:
                     error_msg=f"Unexpected error in cvmfs_extract function: {e}"
                     logging.error(error_msg)
                     send_to_zabbix(error_msg)
+                    cvmfs_abort(cvmfs_repo, "cvmfs_extract")
+                    gone.update(stage_tarballs(cvmfs_repo, batch, puts, staged_tars))
 
 
 def main():
     setup_logging()
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT)
+    try:
+        watcher = DirWatcher(my_cvmfs_path, repo_journal.JOURNAL_DIR)
+    except Exception as e:
+        logging.warning(f"inotify not available, /data/cvmfs checked every {TIME_CHECK} seconds: {e}")
+        watcher = None
+    # Only the repositories changed since the last cycle are synchronized, with a periodic full scan
+    dirty = None
+    next_full_scan = 0
     while True:
-        cvmfs_repo_sync()
-        time.sleep(TIME_CHECK)   
+        if dirty is None or time.monotonic() >= next_full_scan:
+            next_due = cvmfs_repo_sync()
+            next_full_scan = time.monotonic() + (FULL_SCAN_INTERVAL if watcher else TIME_CHECK)
+        elif dirty:
+            next_due = cvmfs_repo_sync(sorted(dirty))
+        else:
+            next_due = schedule_due()
+        timeout = next_full_scan - time.monotonic()
+        if next_due is not None:
+            timeout = min(timeout, next_due)
+        if watcher is None:
+            time.sleep(max(timeout, 0))
+            dirty = set()
+        else:
+            dirty = watcher.wait(max(timeout, 0), EVENT_SETTLE)
 
 
 if __name__ == "__main__":
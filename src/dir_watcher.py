@@ -0,0 +1,112 @@
+
+import os
+import time
+import select
+import struct
+import ctypes
+import logging
+
+# inotify watcher of /data/cvmfs telling cvmfs_repo_sync which repositories changed.
+# Every folder of the repositories is watched for new files (closed after writing or renamed into place)
+# and new folders; the journal folder is watched for writes of the SQLite WAL file.
+# Hidden files (downloads in progress) and the keys folder do not make a repository dirty.
+
+IN_MODIFY                   = 0x00000002
+IN_CLOSE_WRITE              = 0x00000008
+IN_MOVED_TO                 = 0x00000080
+IN_CREATE                   = 0x00000100
+IN_DELETE_SELF              = 0x00000400
+IN_Q_OVERFLOW               = 0x00004000
+IN_IGNORED                  = 0x00008000
+IN_ONLYDIR                  = 0x01000000
+IN_ISDIR                    = 0x40000000
+IN_NONBLOCK                 = 0o4000
+IN_CLOEXEC                  = 0o2000000
+EVENT_HEADER                = struct.Struct("iIII")
+FOLDER_MASK                 = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+JOURNAL_MASK                = IN_MODIFY | IN_DELETE_SELF | IN_ONLYDIR
+EXCLUDED_FOLDERS            = ['keys']
+
+
+class DirWatcher:
+
+    def __init__(self, root, journal_dir):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1: {os.strerror(ctypes.get_errno())}")
+        self.root = root
+        self.journal_dir = journal_dir
+        self.watches = {}                   # watch descriptor -> (repository, folder path)
+        self.add_watch(root, None)
+        for repo in os.listdir(root):
+            if os.path.isdir(os.path.join(root, repo)):
+                self.watch_tree(repo, os.path.join(root, repo))
+
+    def add_watch(self, path, repo):
+        mask = JOURNAL_MASK if os.path.basename(path) == self.journal_dir else FOLDER_MASK
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            logging.warning(f"Cannot watch {path}: {os.strerror(ctypes.get_errno())}")
+        else:
+            self.watches[wd] = (repo, path)
+
+    # Watch a repository folder and all its subfolders
+    def watch_tree(self, repo, path):
+        self.add_watch(path, repo)
+        for folder, subfolders, files in os.walk(path):
+            subfolders[:] = [d for d in subfolders if d not in EXCLUDED_FOLDERS and (d == self.journal_dir or not d.startswith('.'))]
+            for subfolder in subfolders:
+                self.add_watch(os.path.join(folder, subfolder), repo)
+
+    # Wait up to timeout seconds for changes, then collect the events for settle seconds more, never beyond timeout:
+    # a steady flow of events does not keep the caller waiting.
+    # Returns the set of the changed repositories, or None if events were lost and a full scan is needed
+    def wait(self, timeout, settle):
+        dirty = set()
+        deadline = time.monotonic() + timeout
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return dirty
+        deadline = min(deadline, time.monotonic() + settle)
+        while True:
+            if not self.read_events(dirty):
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                return dirty
+
+    def read_events(self, dirty):
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return True
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = os.fsdecode(buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflow, full scan of the repositories needed.")
+                return False
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            repo, folder = self.watches[wd]
+            if repo is None:
+                # New repository folder in /data/cvmfs
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(name, os.path.join(folder, name))
+                    dirty.add(name)
+            elif os.path.basename(folder) == self.journal_dir:
+                if mask & IN_MODIFY and name.endswith("-wal"):
+                    dirty.add(repo)
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and name not in EXCLUDED_FOLDERS and (name == self.journal_dir or not name.startswith('.')):
+                    # Files written before the watch was added are found by the scan of the repository
+                    self.watch_tree(repo, os.path.join(folder, name))
+                    dirty.add(repo)
+            elif name and not name.startswith('.') and os.path.basename(folder) not in EXCLUDED_FOLDERS:
+                dirty.add(repo)
+        return True
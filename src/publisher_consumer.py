@@ -11,7 +11,9 @@ from pathlib import Path
 import shutil
 from datetime import datetime
 import sys
-import socket
+from zabbix_sender import ZabbixSender
+import repo_registry
+import metrics
 
 
 with open("parameters.json") as json_data_file:
@@ -39,16 +41,16 @@ V_ROLEID                    = data["vault"]['role_id']
 V_SECRETID                  = data["vault"]['secret_id']
 ZBX_SERVER                  = data["zabbix"]['proxy_server']
 ZBX_ITEM_KEY                = data["zabbix"]['item_key3']
+ZABBIX                      = ZabbixSender(ZBX_SERVER, ZBX_ITEM_KEY)
+METRICS_PORT                = data.get("metrics", {}).get('port', 0)        # 0 = metrics endpoint disabled
+MESSAGES                    = metrics.Counter('cvmfs_publisher_messages_total', 'Messages processed from the publisher queue', ['result'])
+CVMFS_SERVER_SECONDS        = metrics.Histogram('cvmfs_server_command_seconds', 'Duration of the cvmfs_server commands', ['repo', 'command'])
+VAULT_SECONDS               = metrics.Histogram('cvmfs_vault_request_seconds', 'Duration of the Vault requests', ['operation'])
 
 
-# Alerts sent to Zabbix server
+# Alerts sent to Zabbix server, buffered and sent in batches by a background thread
 def send_to_zabbix(message):
-    HOSTNAME =socket.gethostname()
-    cmd = f'zabbix_sender -z {ZBX_SERVER} -s {HOSTNAME} -k {ZBX_ITEM_KEY} -o "{message}"'
-    try:
-        subprocess.run(cmd, shell=True)
-    except Exception as e:
-        logging.error(f"Zabbix notification failed: {e}")
+    ZABBIX.send(message)
 
 
 # Generate log file with current date and weekly rotation
@@ -132,7 +134,8 @@ def create_queue(channel, repo):
 # VAUL AppRole login method
 def vault_login_approle(client):
     try:
-        client.auth.approle.login(role_id=V_ROLEID,secret_id=V_SECRETID)
+        with VAULT_SECONDS.time(operation='login'):
+            client.auth.approle.login(role_id=V_ROLEID,secret_id=V_SECRETID)
         logging.info("Login to Vault server successful.")
     except hvac.exceptions.InvalidRequest as e:
         error_msg=f'Invalid request error: {e}'
@@ -167,7 +170,8 @@ def get_repo_keys(msg):
             PATH = "secrets/data/"+subject+"/cvmfs_keys/"+repository_name+"/"
         else:
             PATH = "secrets/data/groups/"+repository_name.split('.')[0]+"/cvmfs_keys/"+repository_name+"/"
-        read_response = client.read(path=PATH)
+        with VAULT_SECONDS.time(operation='read'):
+            read_response = client.read(path=PATH)
         p = Path('/tmp/') / f'{repository_name}_keys'
         p.mkdir(exist_ok=True)
         with (p / f'{repository_name}.crt').open('w') as f:
@@ -185,13 +189,18 @@ def get_repo_keys(msg):
 
 # Make a CVMFS repository writable from publisher via gateway
 def create_repo_publisher(repo_name):
-    
+    if repo_registry.is_created(repo_name):
+        logging.info(f"CVMFS repository {repo_name} already created.")
+        shutil.rmtree(f'/tmp/{repo_name}_keys/', ignore_errors=True)
+        return True
     cmd = f'cvmfs_server mkfs -w {CVMFS_SERVER_URL}{repo_name} \
     -u gw,/srv/cvmfs/{repo_name}/data/txn,{CVMFS_UP_STORAGE} \
     -k /tmp/{repo_name}_keys -o `whoami` {repo_name}'
     try:
-       subprocess.run(cmd, shell=True, capture_output=True, check=True)
+       with CVMFS_SERVER_SECONDS.time(repo=repo_name, command="mkfs"):
+           subprocess.run(cmd, shell=True, capture_output=True, check=True)
        logging.info(f'CVMFS repository {repo_name} successfully created.')
+       repo_registry.register(repo_name)
        shutil.rmtree(f'/tmp/{repo_name}_keys/')
        return True
     except subprocess.CalledProcessError as e:
@@ -201,6 +210,7 @@ def create_repo_publisher(repo_name):
         # Case repo already exists 
         if "already exists" in stderr_output:
             logging.info("CVMFS repo not created.")
+            repo_registry.register(repo_name)
             shutil.rmtree(f'/tmp/{repo_name}_keys/')
             return True
         else:
@@ -222,21 +232,27 @@ def callback(ch, method, properties, body):
         res = create_repo_publisher(repo_name)
         if res is not True:
             logging.warning(f'Cannot create CVMFS repo in publisher: {res}. Message NOT acknowledged.')
+            MESSAGES.inc(result='failed')
         else:
             create_t=create_topic(repo_name)
             if create_t is not True:
                 logging.warning(f'Cannot create topic for the CVMFS repo in publisher: {create_t}. Message NOT acknowledged.')
+                MESSAGES.inc(result='failed')
             else:
                 create_q=create_queue(ch, repo_name)
                 if create_q is not True:
                     logging.warning(f'Cannot create queue for the CVMFS repo in publisher: {create_q}. Message NOT acknowledged.')
+                    MESSAGES.inc(result='failed')
                 else:
                     ch.basic_ack(delivery_tag=method.delivery_tag)
+                    MESSAGES.inc(result='acked')
 
 
 
 def main():
         setup_logging()
+        if METRICS_PORT:
+            metrics.start_http_server(METRICS_PORT)
         try: 
             context = ssl.create_default_context(cafile=SSL_CA_CERT)
             context.load_cert_chain(certfile=SSL_CLIENT_CERT, keyfile=SSL_CLIENT_KEY)
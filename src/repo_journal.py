@@ -0,0 +1,102 @@
+
+import os
+import time
+import sqlite3
+import pathlib
+import hashlib
+import zlib
+from contextlib import closing
+
+# Per repository journal of the pending operations, written by cvmfs_repo_consumers and read by cvmfs_repo_sync.
+# It is a SQLite database in WAL mode in /data/cvmfs/<repo>/.journal, the disk shared by the two dockers.
+# Only the last operation of each path is kept: a Put followed by a Delete of the same key leaves only the Delete,
+# repeated Puts leave only one Put. The path is relative to the repository root, e.g. software/netCDF-92.
+# A Put can have a source, s3://bucket/key, when the object is not downloaded in the staging area but streamed by the sync,
+# and the content hash of the downloaded file, compared by the sync with the hash of the published file
+
+JOURNAL_DIR                 = ".journal"        # Hidden: not published by the sync
+JOURNAL_NAME                = "operations.db"
+BUSY_TIMEOUT                = 30                # Seconds waiting for the lock held by the other docker
+READ_TIMEOUT                = 1                 # Seconds waiting for a read-only count, e.g. during a checkpoint
+PUT                         = "put"
+DELETE                      = "delete"
+ADDED_COLUMNS               = ["source", "hash"]    # Added to the journals created before them
+HASH_CHUNK                  = 1024 * 1024
+HASHED_MAX_SIZE             = 4 * 1024 * 1024 # CVMFS_MIN_CHUNK_SIZE: smaller files are never chunked
+
+
+def journal_path(repo_path):
+    return os.path.join(repo_path, JOURNAL_DIR, JOURNAL_NAME)
+
+
+def open_journal(repo_path):
+    os.makedirs(os.path.join(repo_path, JOURNAL_DIR), exist_ok=True)
+    conn = sqlite3.connect(journal_path(repo_path), timeout=BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    # seq is AUTOINCREMENT: a path recorded again always gets a new seq, so that an operation
+    # recorded while the sync is running is not completed by mistake
+    conn.execute("CREATE TABLE IF NOT EXISTS operations ("
+                 "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                 "path TEXT UNIQUE NOT NULL, "
+                 "op TEXT NOT NULL, "
+                 "created REAL NOT NULL, "
+                 "source TEXT, "
+                 "hash TEXT)")
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(operations)")]
+    for column in ADDED_COLUMNS:
+        if column not in columns:
+            try:
+                conn.execute(f"ALTER TABLE operations ADD COLUMN {column} TEXT")
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e):        # Added by the other docker in the meantime
+                    raise
+    return conn
+
+
+# Record an operation, replacing the pending one of the same path
+def record(repo_path, path, op, source=None, hash=None):
+    with closing(open_journal(repo_path)) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO operations (path, op, created, source, hash) VALUES (?, ?, ?, ?, ?)",
+                     (path, op, time.time(), source, hash))
+
+
+# Pending operations as (seq, path, op, created, source, hash) tuples, oldest first
+def pending(repo_path):
+    if not os.path.exists(journal_path(repo_path)):
+        return []
+    with closing(open_journal(repo_path)) as conn:
+        return conn.execute("SELECT seq, path, op, created, source, hash FROM operations ORDER BY seq").fetchall()
+
+
+# Pending operations counted on a read-only connection, without the schema checks of open_journal: in WAL mode it does not
+# wait for the writers. 0 if the journal is busy or not created yet
+def count(repo_path):
+    if not os.path.exists(journal_path(repo_path)):
+        return 0
+    try:
+        with closing(sqlite3.connect(pathlib.Path(journal_path(repo_path)).as_uri() + "?mode=ro", uri=True, timeout=READ_TIMEOUT)) as conn:
+            return conn.execute("SELECT COUNT(*) FROM operations").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+
+# Remove the operations applied by the sync. Operations recorded again in the meantime have a new seq and are kept
+def complete(repo_path, entries):
+    if not entries:
+        return
+    with closing(open_journal(repo_path)) as conn, conn:
+        conn.executemany("DELETE FROM operations WHERE seq = ?", [(entry[0],) for entry in entries])
+
+
+# Content hash of a file as stored in the CVMFS catalogs with the default settings (CVMFS_COMPRESSION_ALGORITHM=default,
+# CVMFS_HASH_ALGORITHM=sha1): the SHA-1 of the object compressed by zlib at the default level, in hex.
+# Files bigger than HASHED_MAX_SIZE can be chunked by the publish and then have no bulk hash: they are not hashed
+def content_hash(file_path):
+    sha1 = hashlib.sha1()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            sha1.update(compressor.compress(chunk))
+    sha1.update(compressor.flush())
+    return sha1.hexdigest()
@@ -0,0 +1,62 @@
+
+import os
+import json
+import logging
+import threading
+
+# Registry of the CVMFS repositories already created on this publisher, so that cvmfs_server mkfs is run only for new repositories.
+# It is a JSON list persisted in the cvmfs spool of the container, next to the /etc/cvmfs of the same container: publisher_consumer
+# and cvmfs_repo_sync run in different containers with their own spool volume, hence their own registry.
+# Only the process of the container uses it: the list is loaded once and kept in memory, the threads are serialized by REGISTRY_LOCK.
+# A repository is created only if it is in the registry and its server configuration exists:
+# a repository removed from /etc/cvmfs/repositories.d is dropped from the registry and created again.
+
+REGISTRY_FILE               = "/var/spool/cvmfs/publisher_repositories.json"
+SERVER_CONFIG_DIR           = "/etc/cvmfs/repositories.d"
+REGISTRY_LOCK               = threading.Lock()
+REGISTRY_CACHE              = {"repos": None}
+
+
+# Called with REGISTRY_LOCK held
+def load():
+    if REGISTRY_CACHE["repos"] is None:
+        try:
+            with open(REGISTRY_FILE) as f:
+                REGISTRY_CACHE["repos"] = set(json.load(f))
+        except FileNotFoundError:
+            REGISTRY_CACHE["repos"] = set()
+    return REGISTRY_CACHE["repos"]
+
+
+# Called with REGISTRY_LOCK held, the file is replaced atomically
+def save(repos):
+    os.makedirs(os.path.dirname(REGISTRY_FILE), exist_ok=True)
+    with open(REGISTRY_FILE + ".tmp", "w") as f:
+        json.dump(sorted(repos), f)
+    os.replace(REGISTRY_FILE + ".tmp", REGISTRY_FILE)
+
+
+def configured(repo_name):
+    return os.path.isfile(os.path.join(SERVER_CONFIG_DIR, repo_name, "server.conf"))
+
+
+def is_created(repo_name):
+    with REGISTRY_LOCK:
+        repos = load()
+        if repo_name not in repos:
+            return False
+        if configured(repo_name):
+            return True
+        repos.discard(repo_name)
+        save(repos)
+    logging.info(f"CVMFS repository {repo_name} not configured anymore, removed from the registry.")
+    return False
+
+
+# Called after mkfs created the repository or reported that it already exists
+def register(repo_name):
+    with REGISTRY_LOCK:
+        repos = load()
+        if repo_name not in repos:
+            repos.add(repo_name)
+            save(repos)
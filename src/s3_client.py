@@ -0,0 +1,84 @@
+
+import time
+import logging
+import threading
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import metrics
+
+# S3 client of the Ceph RGW with the credentials of an assumed STS role, shared by cvmfs_repo_consumers and cvmfs_repo_sync.
+# boto3 clients are thread-safe: one client is shared by all the threads of a process.
+# The assumed role is cached and renewed STS_REFRESH_MARGIN seconds before its expiration.
+
+STS_DURATION                = 3600 # Lifetime of the assumed role credentials
+STS_REFRESH_MARGIN          = 300  # Renew the assumed role 5 minutes before it expires
+S3_MAX_POOL_CONNECTIONS     = 50   # HTTP connections kept by the shared S3 client
+S3_EXPIRED_TOKEN_CODES      = ['ExpiredToken', 'ExpiredTokenException', 'InvalidToken', 'TokenRefreshRequired', '403']  # '403': HEAD responses have no error code
+FORCED_REFRESH_INTERVAL     = 60   # Seconds between two role assumptions forced by rejected tokens, e.g. a bucket policy denial
+STS_SECONDS                 = metrics.Histogram('cvmfs_sts_request_seconds', 'Duration of the STS assume role requests')
+
+
+class S3Client:
+
+    def __init__(self, access_key, secret_key, role, endpoint, region):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.role = role
+        self.endpoint = endpoint
+        self.region = region
+        self.sts = None
+        self.s3 = None
+        self.expiration = 0
+        self.forced_refresh = 0
+        self.lock = threading.Lock()
+
+    # expired: client which got an expired token error, the role is assumed again only if it is still the cached one
+    # and not more than once every FORCED_REFRESH_INTERVAL seconds: a bare 403 can also be a denied access
+    def client(self, expired=None):
+        with self.lock:
+            if self.s3 is not None and time.time() < self.expiration - STS_REFRESH_MARGIN:
+                if self.s3 is not expired or time.time() < self.forced_refresh + FORCED_REFRESH_INTERVAL:
+                    return self.s3
+                self.forced_refresh = time.time()
+            if self.sts is None:
+                self.sts = boto3.client(
+                    'sts',
+                    aws_access_key_id=self.access_key,
+                    aws_secret_access_key=self.secret_key,
+                    endpoint_url=self.endpoint,
+                    region_name=self.region
+                    )
+            with STS_SECONDS.time():
+                response = self.sts.assume_role(
+                    RoleArn=f'arn:aws:iam:::role/{self.role}',
+                    RoleSessionName='Bob',
+                    DurationSeconds=STS_DURATION
+                    )
+            self.s3 = boto3.client(
+                's3',
+                aws_access_key_id=response['Credentials']['AccessKeyId'],
+                aws_secret_access_key=response['Credentials']['SecretAccessKey'],
+                aws_session_token=response['Credentials']['SessionToken'],
+                endpoint_url=self.endpoint,
+                region_name=self.region,
+                config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+                )
+            self.expiration = response['Credentials']['Expiration'].timestamp()
+            logging.info(f"STS role {self.role} assumed, credentials valid until {response['Credentials']['Expiration']}.")
+            return self.s3
+
+    # Call a method of the S3 client, assuming the role again and retrying once if the token is rejected
+    def call(self, method, *args, **kwargs):
+        s3 = self.client()
+        try:
+            return getattr(s3, method)(*args, **kwargs)
+        except ClientError as e:
+            if not expired_token(e):
+                raise
+            logging.info(f"S3 credentials rejected ({e.response['Error']['Code']}), refreshing STS credentials.")
+            return getattr(self.client(expired=s3), method)(*args, **kwargs)
+
+
+def expired_token(error):
+    return error.response['Error']['Code'] in S3_EXPIRED_TOKEN_CODES
@@ -0,0 +1,84 @@
+
+import shutil
+import tarfile
+import threading
+import subprocess
+from contextlib import contextmanager
+try:
+    import zstandard
+except ImportError:                 # Optional: the zstd command is used instead
+    zstandard = None
+
+# Software bundles uploaded as tarballs, plain or compressed, shared by cvmfs_repo_consumers and cvmfs_repo_sync.
+# A bundle is ingested in software/ and deleted as software/<bundle name>, e.g. software/oidc-agent_5.1.0
+# for oidc-agent_5.1.0.tar, oidc-agent_5.1.0.tar.gz or oidc-agent_5.1.0.tar.zst
+
+TARBALL_EXTENSIONS          = {'.tar': '', '.tar.gz': 'gz', '.tgz': 'gz', '.tar.bz2': 'bz2', '.tbz2': 'bz2',
+                               '.tar.xz': 'xz', '.txz': 'xz', '.tar.zst': 'zst', '.tar.zstd': 'zst', '.tzst': 'zst'}
+COPY_CHUNK                  = 1024 * 1024
+
+
+# Longest extension of the tarball, None if name is not a tarball
+def extension(name):
+    matches = [ext for ext in TARBALL_EXTENSIONS if name.endswith(ext)]
+    return max(matches, key=len) if matches else None
+
+
+def is_tarball(name):
+    return extension(name) is not None
+
+
+def bundle_name(name):                                      # name=oidc-agent_5.1.0.tar.gz
+    return name[:-len(extension(name))]                     # bundle name=oidc-agent_5.1.0
+
+
+# Open the tarball read from fileobj in stream mode, decompressing it on the fly: gz, bz2 and xz by tarfile,
+# zstd by the zstandard module if installed, otherwise by a zstd process fed by a thread
+@contextmanager
+def open_stream(fileobj, name, bufsize):
+    compression = TARBALL_EXTENSIONS[extension(name)]
+    if compression != 'zst':
+        with tarfile.open(fileobj=fileobj, mode=f"r|{compression}", bufsize=bufsize) as tar:
+            yield tar
+    elif zstandard is not None:
+        with zstandard.ZstdDecompressor().stream_reader(fileobj, read_size=bufsize, closefd=False) as reader, \
+             tarfile.open(fileobj=reader, mode="r|", bufsize=bufsize) as tar:
+            yield tar
+    else:
+        with zstd_process(fileobj) as reader, tarfile.open(fileobj=reader, mode="r|", bufsize=bufsize) as tar:
+            yield tar
+
+
+@contextmanager
+def zstd_process(fileobj):
+    proc = subprocess.Popen(["zstd", "-dcq"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    errors = []
+    feeder = threading.Thread(target=feed, args=(fileobj, proc.stdin, errors), name="zstd-feeder", daemon=True)
+    feeder.start()
+    try:
+        yield proc.stdout
+        # The whole stream must have been decompressed, also the padding after the end of the archive
+        while proc.stdout.read(COPY_CHUNK):
+            pass
+        if proc.wait() != 0:
+            raise tarfile.ReadError(f"zstd exited with code {proc.returncode}")
+        feeder.join()
+        if errors:
+            raise errors[0]
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+
+def feed(fileobj, stdin, errors):
+    try:
+        shutil.copyfileobj(fileobj, stdin, COPY_CHUNK)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
@@ -0,0 +1,102 @@
+
+import json
+import time
+import atexit
+import socket
+import struct
+import logging
+import threading
+
+# Zabbix trapper client speaking the sender protocol, shared by the scripts instead of running zabbix_sender.
+# send() only buffers the alert: a background thread flushes the buffer every FLUSH_INTERVAL seconds.
+# Identical messages are sent at most once every DEDUP_WINDOW seconds with the number of occurrences,
+# and at most RATE_LIMIT alerts are sent per minute.
+
+ZBX_PORT                    = 10051
+ZBX_HEADER                  = b"ZBXD\x01"
+FLUSH_INTERVAL              = 5
+DEDUP_WINDOW                = 60
+RATE_LIMIT                  = 60
+MAX_PENDING                 = 1000      # Different messages waiting to be sent, the others are counted and dropped
+TIMEOUT                     = 10
+
+
+class ZabbixSender:
+
+    def __init__(self, server, item_key, host=None, port=ZBX_PORT):
+        self.server = server
+        self.port = port
+        self.item_key = item_key
+        self.host = host or socket.gethostname()
+        self.pending = {}                   # message -> [occurrences, clock of the first one]
+        self.last_sent = {}                 # message -> time it was last sent
+        self.sent_times = []                # send times in the last minute, for the rate limit
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # Hot path: only updates the buffer
+    def send(self, message):
+        with self.lock:
+            if message in self.pending:
+                self.pending[message][0] += 1
+            elif len(self.pending) < MAX_PENDING:
+                self.pending[message] = [1, int(time.time())]
+            else:
+                self.dropped += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="zabbix-sender", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush, True)
+
+    def run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    # Send the buffered alerts which are out of their deduplication window, within the rate limit.
+    # force: send everything regardless of the window and of the rate limit, e.g. at exit
+    def flush(self, force=False):
+        now = time.time()
+        data = []
+        with self.lock:
+            self.sent_times = [t for t in self.sent_times if now - t < 60]
+            for message in list(self.pending):
+                if not force and (now - self.last_sent.get(message, 0) < DEDUP_WINDOW or len(self.sent_times) >= RATE_LIMIT):
+                    continue
+                count, clock = self.pending.pop(message)
+                data.append({"host": self.host, "key": self.item_key, "clock": clock,
+                             "value": message if count == 1 else f"{message} (x{count})"})
+                self.last_sent[message] = now
+                self.sent_times.append(now)
+            if self.dropped and (force or len(self.sent_times) < RATE_LIMIT):
+                data.append({"host": self.host, "key": self.item_key, "clock": int(now),
+                             "value": f"{self.dropped} alerts dropped, too many different messages."})
+                self.dropped = 0
+                self.sent_times.append(now)
+            self.last_sent = {m: t for m, t in self.last_sent.items() if now - t < DEDUP_WINDOW}
+        if data:
+            self.send_data(data)
+
+    def send_data(self, data):
+        payload = json.dumps({"request": "sender data", "data": data}).encode("utf-8")
+        try:
+            with socket.create_connection((self.server, self.port), timeout=TIMEOUT) as sock:
+                sock.sendall(ZBX_HEADER + struct.pack("<Q", len(payload)) + payload)
+                response = recv_response(sock)
+            if response.get("response") != "success":
+                logging.error(f"Zabbix notification failed: {response}")
+        except Exception as e:
+            logging.error(f"Zabbix notification failed: {e}")
+
+
+def recv_response(sock):
+    buffer = b""
+    while len(buffer) < 13 or len(buffer) < 13 + struct.unpack("<Q", buffer[5:13])[0]:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        buffer += chunk
+    if not buffer.startswith(ZBX_HEADER):
+        raise ValueError(f"invalid response from Zabbix server: {buffer[:13]!r}")
+    return json.loads(buffer[13:].decode("utf-8"))
@@ -0,0 +1,103 @@
+import json
+import time
+import socket
+import struct
+import threading
+import pytest
+import zabbix_sender
+from zabbix_sender import ZabbixSender, ZBX_HEADER
+
+
+# Fake Zabbix trapper on localhost: records the raw requests and answers like the server
+class FakeTrapper:
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.requests = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                raw = b""
+                while len(raw) < 13 or len(raw) < 13 + struct.unpack("<Q", raw[5:13])[0]:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    raw += chunk
+                self.requests.append(raw)
+                response = json.dumps({"response": "success", "info": "processed: 1; failed: 0"}).encode()
+                conn.sendall(ZBX_HEADER + struct.pack("<Q", len(response)) + response)
+
+    def values(self):
+        return [item["value"] for raw in self.requests for item in json.loads(raw[13:])["data"]]
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def trapper():
+    server = FakeTrapper()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def sender(trapper):
+    return ZabbixSender("127.0.0.1", "cvmfs.alert", host="publisher01", port=trapper.port)
+
+
+def test_framing(trapper, sender):
+    sender.send("disk full")
+    sender.flush()
+    raw = trapper.requests[0]
+    assert raw[:5] == ZBX_HEADER
+    assert struct.unpack("<Q", raw[5:13])[0] == len(raw) - 13
+    payload = json.loads(raw[13:])
+    assert payload["request"] == "sender data"
+    assert payload["data"] == [{"host": "publisher01", "key": "cvmfs.alert", "clock": payload["data"][0]["clock"], "value": "disk full"}]
+
+
+def test_duplicates_collapsed(trapper, sender):
+    for _ in range(3):
+        sender.send("publish failed")
+    sender.send("mkfs failed")
+    sender.flush()
+    assert sorted(trapper.values()) == ["mkfs failed", "publish failed (x3)"]
+    # Within the deduplication window the message is held back, then sent at exit
+    sender.send("publish failed")
+    sender.flush()
+    assert len(trapper.requests) == 1
+    sender.flush(force=True)
+    assert trapper.values()[-1] == "publish failed"
+
+
+def test_rate_limit(trapper, sender, monkeypatch):
+    monkeypatch.setattr(zabbix_sender, "RATE_LIMIT", 3)
+    for i in range(5):
+        sender.send(f"error {i}")
+    sender.flush()
+    assert trapper.values() == ["error 0", "error 1", "error 2"]
+    sender.flush()
+    assert len(trapper.values()) == 3
+    sender.flush(force=True)
+    assert trapper.values()[3:] == ["error 3", "error 4"]
+
+
+# send() is on the hot path of the scripts: it only buffers, a few microseconds per alert
+def test_send_does_not_wait_for_the_server(sender):
+    sender.send("warm up")
+    count = 10000
+    start = time.perf_counter()
+    for i in range(count):
+        sender.send(f"error {i % 10}")
+    elapsed = (time.perf_counter() - start) / count
+    assert elapsed < 50e-6